@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import datatypes
+import db_worker as dbw
+
+# синтетический "вечер": N колов по 5-20 человек, у части есть ветка
+EVENTS = int(os.getenv("BENCH_EVENTS", "500"))
+USERS = 300
+
+
+def make_events(n: int) -> list[datatypes.Event]:
+    rnd = random.Random(42)
+    users = [datatypes.User(uuid=10_000 + i, server_username=f"user{i}") for i in range(USERS)]
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    events = []
+    for i in range(n):
+        event = datatypes.Event(
+            message_id=1_000_000 + i,
+            message_text=f"zvz call {i}",
+            read_time=start + timedelta(minutes=i),
+            author=rnd.choice(users),
+            mentioned_users=rnd.sample(users, rnd.randint(5, 20)),
+            channel_id=1363140680985346242,
+            channel_name="zvz",
+            points=5,
+        )
+        for j in range(rnd.randint(0, 10)):
+            event.branch_messages.append(datatypes.BranchMessage(
+                message_id=5_000_000 + i * 100 + j,
+                message_text="+",
+                read_time=event.read_time,
+            ))
+        events.append(event)
+    return events
+
+
+def bench(name: str, write) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        worker = dbw.DBWorker(os.path.join(tmp, "bench.db"))
+        events = make_events(EVENTS)
+        rows = sum(2 + 2 * len(e.mentioned_users) + len(e.branch_messages) for e in events)
+        started = time.perf_counter()
+        write(worker, events)
+        elapsed = time.perf_counter() - started
+        worker.close()
+    print(f"{name:>12}: {len(events)} events, {rows} rows in {elapsed:.2f}s -> {rows / elapsed:,.0f} rows/s")
+    return elapsed
+
+
+def row_by_row(worker: dbw.DBWorker, events: list[datatypes.Event]):
+    # старый путь: коммит после каждого INSERT, пользователь пишется каждый раз
+    # (мимо UserCache - кэш появился вместе с батчами)
+    for event in events:
+        worker.execute(dbw.INSERT_USER_SQL, dbw.user_row(event.author))
+        worker.execute(dbw.INSERT_EVENT_SQL, dbw.event_row(event))
+        for mu in event.mentioned_users:
+            worker.execute(dbw.INSERT_USER_SQL, dbw.user_row(mu))
+        for bm in event.branch_messages:
+            worker.add_branch_message(bm, event.message_id)
+        for mu in event.mentioned_users:
+            worker.add_event_user_link(mu.uuid, event.message_id)
+
+
+def batched(worker: dbw.DBWorker, events: list[datatypes.Event]):
+    with worker.batch() as batch:
+        for event in events:
+            batch.add(event)
+
+
+if __name__ == "__main__":
+    before = bench("row-by-row", row_by_row)
+    after = bench("batched", batched)
+    print(f"speedup: x{before / after:.1f}")
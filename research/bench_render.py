@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from flask import render_template_string
+import app as site
+import datatypes
+import db_queries
+import db_worker as dbw
+
+# сравнение старого рендера (render_template_string дважды на запрос)
+# с заранее скомпилированными шаблонами
+RUNS = int(os.getenv("BENCH_RUNS", "200"))
+ROWS = int(os.getenv("BENCH_ROWS", "400"))
+# событий у пользователя на странице /user/<uid>, каждое десятое - из скрытого канала
+USER_EVENTS = int(os.getenv("BENCH_USER_EVENTS", "2000"))
+
+with open(os.path.join(site.TEMPLATE_DIR, 'base.html')) as f:
+    BASE_HTML = f.read()
+with open(os.path.join(site.TEMPLATE_DIR, 'index.html')) as f:
+    INDEX_HTML = f.read()
+with open(os.path.join(site.TEMPLATE_DIR, 'user.html')) as f:
+    USER_HTML = f.read()
+
+rows = [
+    {'uid': 10_000 + i, 'display_name': f"user{i}", 'liable': 1, 'event_count': i % 30,
+     'total_points': i % 90, 'need_to_get': 45, 'is_member': 1}
+    for i in range(ROWS)
+]
+context = dict(title='мемберы × контент', subtitle=f'Всего мемберов: {ROWS}', archives=[], db_param=None)
+
+
+def string_templates():
+    html = render_template_string(INDEX_HTML, rows=rows, db_param=None)
+    return render_template_string(BASE_HTML, content=html, **context)
+
+
+def compiled_templates():
+    return site.INDEX_PAGE.render(rows=rows, **context)
+
+
+def make_user_db(path: str) -> int:
+    worker = dbw.DBWorker(path)
+    user = datatypes.User(uuid=10_000, server_username="user0")
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    with worker.batch() as batch:
+        for i in range(USER_EVENTS):
+            batch.add(datatypes.Event(
+                message_id=1_000_000 + i, message_text=f"zvz call {i}", read_time=start + timedelta(minutes=i),
+                author=user, mentioned_users=[user], channel_id=1363140680985346242, channel_name="zvz",
+                guild_id=1, points=5, hidden=i % 10 == 0,
+            ))
+    worker.close()
+    return user.uuid
+
+
+def user_string_templates(db: sqlite3.Connection, uid: int):
+    # старый /user/<uid>: все события в список, маскировка в python, два render_template_string
+    user = db.execute(db_queries.USER_QUERY, (uid,)).fetchone()
+    events = db.execute("""
+        SELECT e.message_id, e.guild_id, e.channel_id, e.channel_name, e.message_text, e.read_time, e.disband, e.points, e.hidden
+        FROM EVENTS_TO_USERS etu
+        JOIN EVENTS e ON e.message_id = etu.message_id
+        WHERE etu.ds_uid = ?
+        ORDER BY e.message_id DESC
+    """, (uid,)).fetchall()
+    for i in range(len(events)):
+        if events[i]['hidden']:
+            events[i] = dict(events[i])
+            events[i]['channel_name'] = "None"
+            events[i]['message_text'] = "А тебя это ебать не должно"
+            events[i]['channel_id'] = 0
+            events[i]['message_id'] = 0
+            events[i]['guild_id'] = 0
+    subtitle = f"Сходил на {len(events)} контентов (✓ — проведенные, ✗ — дизбанднутые)"
+    html = render_template_string(USER_HTML, events=events, db_param=None, uid=uid)
+    return render_template_string(BASE_HTML, title=user['display_name'], subtitle=subtitle, content=html, archives=[], db_param=None)
+
+
+def user_streamed(db: sqlite3.Connection, uid: int, first_chunk: list = None):
+    # новый /user/<uid>: COUNT по индексу, маскировка в sql, строки из курсора через generate
+    started = time.perf_counter()
+    user = db.execute(db_queries.USER_QUERY, (uid,)).fetchone()
+    event_count = db.execute(db_queries.USER_EVENT_COUNT_QUERY, (uid,)).fetchone()[0]
+    events = db.execute(db_queries.USER_EVENTS_QUERY, (uid,))
+    subtitle = f"Сходил на {event_count} контентов (✓ — проведенные, ✗ — дизбанднутые)"
+    chunks = site.USER_PAGE.generate(title=user['display_name'], subtitle=subtitle, events=events, archives=[], db_param=None, uid=uid)
+    parts = [next(chunks)]
+    if first_chunk is not None:
+        first_chunk.append((time.perf_counter() - started) * 1000)
+    parts.extend(chunks)
+    return "".join(parts)
+
+
+def measure(name: str, render, size: str = f"{ROWS} rows"):
+    timings = []
+    with site.app.test_request_context('/'):
+        render()
+        for _ in range(RUNS):
+            started = time.perf_counter()
+            render()
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:>10}: p50 {p50:.2f} ms, p99 {p99:.2f} ms ({RUNS} runs, {size})")
+
+
+if __name__ == "__main__":
+    print("/ (leaderboard):")
+    measure("string", string_templates)
+    measure("compiled", compiled_templates)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        uid = make_user_db(path)
+        db = sqlite3.connect(path)
+        db.row_factory = sqlite3.Row
+        first_chunk = []
+        print("/user/<uid>:")
+        size = f"{USER_EVENTS} events"
+        measure("string", lambda: user_string_templates(db, uid), size)
+        measure("streamed", lambda: user_streamed(db, uid, first_chunk), size)
+        print(f"{'streamed':>10}: first chunk p50 {statistics.median(first_chunk):.2f} ms")
+        db.close()
@@ -39,13 +39,28 @@ if REACT_TO_MESSAGES is None:
 else:
     REACT_TO_MESSAGES = str(REACT_TO_MESSAGES).strip().lower() in ("1", "true", "yes", "y", "on")
 
+# лимит на реакции: в среднем REACTION_RATE в секунду на канал, всплеском до REACTION_BURST
+REACTION_RATE = float(os.getenv("REACTION_RATE", "4"))
+REACTION_BURST = int(os.getenv("REACTION_BURST", "5"))
+
 MONTHLY_CALC = os.getenv("MONTHLY_CALC")
 if MONTHLY_CALC is None:
     MONTHLY_CALC = False
 else:
     MONTHLY_CALC = str(MONTHLY_CALC).strip().lower() in ("1", "true", "yes", "y", "on")
 
+# только отчет по уже пересчитанной базе, без обхода каналов (см. recompute.py)
+REPORT_ONLY = str(os.getenv("REPORT_ONLY", "")).strip().lower() in ("1", "true", "yes", "y", "on")
+
+CHANNEL_CONCURRENCY = int(os.getenv("CHANNEL_CONCURRENCY", "4"))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "200"))
+THREAD_WORKERS = int(os.getenv("THREAD_WORKERS", "4"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "32"))
+
 REPORT_CHANNEL_ID = 1355432420320739429
+# формат месячного отчета (xlsx, csv, parquet) и лимит вложения discord в байтах
+REPORT_FORMAT = os.getenv("REPORT_FORMAT", "xlsx")
+DISCORD_ATTACHMENT_LIMIT = int(os.getenv("DISCORD_ATTACHMENT_LIMIT", str(10 * 1024 * 1024)))
 ADMIN_ROLES = {
     "Rentor": 0,
     "Officer": 2,
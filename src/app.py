@@ -1,11 +1,24 @@
 import os
 import sqlite3
-import re
-from flask import Flask, g, render_template_string, request, url_for, abort
+import hashlib
+import atexit
+from datetime import datetime, timezone
+from functools import wraps
+from flask import Flask, g, request, Response, stream_with_context, abort, make_response, jsonify
+from werkzeug.http import is_resource_modified
+from markupsafe import Markup, escape
 import dotenv
+import db_queries
+import db_connections
+import page_cache
+import archive_catalog
+import archive_history
+import archive_snapshot
+import maintenance
 dotenv.load_dotenv()
 
-app = Flask(__name__)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+app = Flask(__name__, template_folder=TEMPLATE_DIR)
 DB_PATH = os.environ.get("DB_PATH", os.path.join(
     os.path.dirname(os.path.abspath(__file__)),
     'sengoku_bot.db'
@@ -13,99 +26,161 @@ DB_PATH = os.environ.get("DB_PATH", os.path.join(
 
 ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archives')
 
-with open(os.path.join(
-    os.path.dirname(os.path.abspath(__file__)),
-    'static', 'base.html'
-)) as f:
-    BASE_HTML = f.read()
+with open(os.path.join(TEMPLATE_DIR, 'timeout.html')) as f:
+    TECHNICAL_TIMEOUT_HTML = f.read()
 
-with open(os.path.join(
-    os.path.dirname(os.path.abspath(__file__)),
-    'static', 'index.html'
-)) as f:
-    INDEX_HTML = f.read()
+# шаблоны компилируются один раз при старте и дальше берутся из кэша jinja;
+# страницы собираются наследованием от base.html, поэтому их можно отдавать потоком
+app.jinja_env.auto_reload = False
+INDEX_PAGE = app.jinja_env.get_template('index_page.html')
+USER_PAGE = app.jinja_env.get_template('user_page.html')
+HISTORY_PAGE = app.jinja_env.get_template('history_page.html')
+TRENDS_PAGE = app.jinja_env.get_template('trends_page.html')
+SEARCH_PAGE = app.jinja_env.get_template('search_page.html')
+TECHNICAL_TIMEOUT_PAGE = app.jinja_env.from_string(TECHNICAL_TIMEOUT_HTML + "<body><h1>Ведутся технические работы</h1><p>Извините за неудобства, скоро всё починим.</p></body></html>")
 
-with open(os.path.join(
-    os.path.dirname(os.path.abspath(__file__)),
-    'static', 'user.html'
-)) as f:
-    USER_HTML = f.read()
+# архивы не меняются - браузер может держать их страницы долго
+ARCHIVE_MAX_AGE = int(os.environ.get("ARCHIVE_MAX_AGE", 24 * 60 * 60))
+ARCHIVES = archive_catalog.ArchiveCatalog(ARCHIVE_DIR)
+# агрегаты архивов считаются один раз и лежат в отдельной базе-индексе
+HISTORY = archive_history.ArchiveHistory(ARCHIVES)
+# готовые таблицы архивов (пишет monthly_results), без них - обычный sql
+SNAPSHOTS = archive_snapshot.SnapshotStore()
+POOL = db_connections.ReaderPool(int(os.environ.get("DB_POOL_SIZE", 8)))
+atexit.register(POOL.close_all)
+atexit.register(SNAPSHOTS.close)
+PAGES = page_cache.PageCache(int(os.environ.get("PAGE_CACHE_SIZE", 256)))
+TEMPLATES_VERSION = hashlib.sha1(b"".join(
+    open(os.path.join(TEMPLATE_DIR, name), 'rb').read()
+    for name in ('base.html', 'index.html', 'index_page.html', 'user.html', 'user_page.html',
+                 'history.html', 'history_page.html', 'trends.html', 'trends_page.html',
+                 'search.html', 'search_page.html')
+)).hexdigest()[:8]
 
-with open(os.path.join(
-    os.path.dirname(os.path.abspath(__file__)),
-    'static', 'timeout.html'
-)) as f:
-    TECHNICAL_TIMEOUT_HTML = f.read()
+@app.template_filter('highlight')
+def highlight(snippet):
+    # snippet() помечает совпадения \x02 ... \x03 - текст экранируем, метки превращаем в <mark>
+    return Markup(str(escape(snippet or '')).replace('\x02', '<mark>').replace('\x03', '</mark>'))
 
 def get_archives():
-    if not os.path.exists(ARCHIVE_DIR):
-        return []
-    files = [f for f in os.listdir(ARCHIVE_DIR) if f.endswith('.db')]
-    archives = []
-    for f in files:
-        base = f[:-3]
-        if re.match(r'^[a-z]+_\d{4}$', base):
-            parts = base.split('_')
-            month, year = parts
-            name = f"{month.capitalize()} {year}"
-            archives.append({'file': base, 'name': name})
-    archives.sort(key=lambda x: x['file'], reverse=True)
-    return archives
+    return ARCHIVES.list()
 
 def get_db(db_path=None) -> sqlite3.Connection:
-    # Use a cache dictionary inside g
+    # соединения берутся из пула на время запроса и возвращаются в close_db
     if not hasattr(g, '_db_cache'):
         g._db_cache = {}
 
-    key = db_path or "default"
-    if key not in g._db_cache:
-        path = db_path or DB_PATH
-        conn = sqlite3.connect(path)
-        conn.row_factory = sqlite3.Row
-        g._db_cache[key] = conn
+    path = db_path or DB_PATH
+    if path not in g._db_cache:
+        g._db_cache[path] = POOL.acquire(path, immutable=db_path is not None)
+
+    return g._db_cache[path]
 
-    return g._db_cache[key]
+def resolve_db(db_param):
+    if not db_param:
+        # на техработах вместо текущей базы показываем последний архив
+        if maintenance.current_mode() == 'archive' and get_archives():
+            latest = get_archives()[0]
+            return latest['path'], f"{latest['name']} (ведутся технические работы)"
+        return None, None
+    # только архивы из каталога - заодно защищает от path traversal
+    archive = ARCHIVES.get(db_param)
+    if archive is None:
+        abort(404)
+    return archive['path'], archive['name']
+
+def get_snapshot(db_path):
+    # with get_snapshot(...) as snapshot: None - снапшота нет, читаем sql
+    archive = ARCHIVES.get(os.path.basename(db_path)[:-3]) if db_path else None
+    return SNAPSHOTS.use(archive)
+
+def data_version(db_path=None):
+    # версия данных = размер и mtime файла базы и ее WAL (коллектор пишет в WAL),
+    # плюс папка архивов (от нее зависит боковое меню) и шаблоны
+    path = db_path or DB_PATH
+    stats = [os.stat(p) for p in (path, path + '-wal') if os.path.exists(p)]
+    # пустой WAL появляется и исчезает вместе с соединениями, данных в нем нет
+    stats = [st for i, st in enumerate(stats) if i == 0 or st.st_size > 0]
+    if os.path.exists(ARCHIVE_DIR):
+        stats.append(os.stat(ARCHIVE_DIR))
+    parts = [f"{st.st_size:x}-{st.st_mtime_ns:x}" for st in stats] + [TEMPLATES_VERSION]
+    etag = hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+    last_modified = datetime.fromtimestamp(max((st.st_mtime for st in stats), default=0), timezone.utc)
+    return etag, last_modified
+
+def cache_stream(key, chunks):
+    # отдаем куски сразу, а в кэш кладем страницу целиком, когда она дорендерилась
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    PAGES.put(key, "".join(parts))
+
+def conditional(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        mode = maintenance.current_mode()
+        if mode == 'timeout' or (mode == 'archive' and not get_archives()):
+            response = make_response(TECHNICAL_TIMEOUT_PAGE.render(), 503)
+            response.cache_control.no_store = True
+            return response
+        if mode and not request.args.get('db'):
+            # режим включается и выключается без рестарта - такие ответы не кэшируем
+            response = make_response(view(*args, **kwargs))
+            response.cache_control.no_store = True
+            return response
+        db_param = request.args.get('db')
+        db_path, _ = resolve_db(db_param)
+        etag, last_modified = data_version(db_path)
+        if not db_param:
+            PAGES.invalidate_live(etag)
+        if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            key = (request.path, db_param, etag, request.query_string)
+            html = PAGES.get(key)
+            if html is None:
+                html = view(*args, **kwargs)
+                # json api отдает готовый Response - ему только ETag/304, без кэша страниц
+                if isinstance(html, str):
+                    PAGES.put(key, html)
+                elif not isinstance(html, Response):
+                    html = Response(stream_with_context(cache_stream(key, html)), mimetype='text/html')
+            response = make_response(html)
+        else:
+            response = make_response('', 304)
+        if response.status_code not in (200, 304):
+            return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        if db_param:
+            response.cache_control.public = True
+            response.cache_control.max_age = ARCHIVE_MAX_AGE
+        else:
+            # текущая база меняется каждую ночь - браузер переспрашивает, но получает 304
+            response.cache_control.no_cache = True
+        return response
+    return wrapper
 
 @app.teardown_appcontext
 def close_db(exception):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    for path, db in g.pop('_db_cache', {}).items():
+        POOL.release(path, db)
 
 @app.route('/')
+@conditional
 def index():
     db_param = request.args.get('db')
-    db_path = None
-    history_title = None
-    if db_param:
-        # Validate to prevent path traversal
-        if not re.match(r'^[a-z]+_\d{4}$', db_param):
-            abort(404)
-        db_path = os.path.join(ARCHIVE_DIR, f"{db_param}.db")
-        if not os.path.exists(db_path):
-            abort(404)
-        history_title = ' '.join([word.capitalize() for word in db_param.split('_')])
+    db_path, history_title = resolve_db(db_param)
 
-    if os.getenv("TECHNICAL_TIMEOUT", "0") == "1":
-        return render_template_string(TECHNICAL_TIMEOUT_HTML + "<body><h1>Ведутся технические работы</h1><p>Извините за неудобства, скоро всё починим.</p></body></html>")
-    
-    db = get_db(db_path)
-    q = db.execute("""
-      SELECT u.uid,
-           COALESCE(NULLIF(u.server_username, ''), u.global_username) AS display_name,
-           u.liable,
-           COUNT(DISTINCT CASE WHEN e.disband != 1 THEN e.message_id END) AS event_count,
-           COALESCE(SUM(CASE WHEN e.disband != 1 THEN e.points ELSE 0 END), 0) AS total_points,
-           u.need_to_get,
-           u.is_member
-      FROM USERS u
-      LEFT JOIN EVENTS_TO_USERS etu ON etu.ds_uid = u.uid
-      LEFT JOIN EVENTS e ON e.message_id = etu.message_id
-      WHERE COALESCE(NULLIF(u.server_username, ''), u.global_username) != 'D9dka'
-      GROUP BY u.uid
-      ORDER BY total_points DESC, event_count DESC, display_name COLLATE NOCASE ASC
-    """)
-    rows = q.fetchall()
+    with get_snapshot(db_path) as snapshot:
+        rows = snapshot.leaderboard() if snapshot else None
+    if rows is None:
+        db = get_db(db_path)
+        # старые архивы без USER_TOTALS считаем исходным агрегатом
+        if db_queries.has_table(db, 'USER_TOTALS'):
+            q = db.execute(db_queries.LEADERBOARD_QUERY)
+        else:
+            q = db.execute(db_queries.LEADERBOARD_AGGREGATE_QUERY)
+        rows = q.fetchall()
     
     archives = get_archives()
     
@@ -113,53 +188,230 @@ def index():
     if history_title:
         subtitle = f'Historical Data: {history_title} | {subtitle}'
     
-    html = render_template_string(INDEX_HTML, rows=rows, db_param=db_param)
-    return render_template_string(BASE_HTML, title='мемберы × контент', subtitle=subtitle, content=html, archives=archives, db_param=db_param)
+    return INDEX_PAGE.render(title='мемберы × контент', subtitle=subtitle, rows=rows, archives=archives, db_param=db_param)
 
 
 @app.route('/user/<int:uid>')
+@conditional
 def user_detail(uid):
     db_param = request.args.get('db')
-    db_path = None
-    history_title = None
-    if db_param:
-        if not re.match(r'^[a-z]+_\d{4}$', db_param):
+    db_path, history_title = resolve_db(db_param)
+
+    with get_snapshot(db_path) as snapshot:
+        data = snapshot.user(uid) if snapshot else None
+    if snapshot:
+        if not data:
             abort(404)
-        db_path = os.path.join(ARCHIVE_DIR, f"{db_param}.db")
-        if not os.path.exists(db_path):
+        user, event_count, events = data['user'], data['event_count'], data['events']
+    else:
+        db = get_db(db_path)
+        uq = db.execute(db_queries.USER_QUERY, (uid,))
+        user = uq.fetchone()
+        if not user:
             abort(404)
-        history_title = ' '.join([word.capitalize() for word in db_param.split('_')])
-    
-    db = get_db(db_path)
-    uq = db.execute("SELECT uid, COALESCE(NULLIF(global_username, ''), server_username) AS display_name FROM USERS WHERE uid=?", (uid,))
-    user = uq.fetchone()
-    if not user:
-        abort(404)
-    eq = db.execute("""
-        SELECT e.message_id, e.guild_id, e.channel_id, e.channel_name, e.message_text, e.read_time, e.disband, e.points, e.hidden
-        FROM EVENTS_TO_USERS etu
-        JOIN EVENTS e ON e.message_id = etu.message_id
-        WHERE etu.ds_uid = ?
-        ORDER BY e.message_id DESC
-    """, (uid,))
-    events = eq.fetchall()
-    for i in range(len(events)):
-        if events[i]['hidden']:
-            events[i] = dict(events[i])
-            events[i]['channel_name'] = f"None"
-            events[i]['message_text'] = "А тебя это ебать не должно"
-            events[i]['channel_id'] = 0
-            events[i]['message_id'] = 0
-            events[i]['guild_id'] = 0
-    
+        event_count = db.execute(db_queries.USER_EVENT_COUNT_QUERY, (uid,)).fetchone()[0]
+        events = db.execute(db_queries.USER_EVENTS_QUERY, (uid,))
+
     archives = get_archives()
-    
-    subtitle = f"Сходил на {len(events)} контентов (✓ — проведенные, ✗ — дизбанднутые)"
+
+    subtitle = f"Сходил на {event_count} контентов (✓ — проведенные, ✗ — дизбанднутые)"
     if history_title:
         subtitle = f"{subtitle} (Historical: {history_title})"
-    
-    html = render_template_string(USER_HTML, events=events, db_param=db_param)
-    return render_template_string(BASE_HTML, title=f"{user['display_name'] or 'без имени'}", subtitle=subtitle, content=html, archives=archives, db_param=db_param)
+
+    # длинная история отдается потоком: строки читаются из курсора по мере рендера
+    return USER_PAGE.generate(title=f"{user['display_name'] or 'без имени'}", subtitle=subtitle, events=events, archives=archives, db_param=db_param, uid=uid)
+
+
+@app.route('/user/<int:uid>/history')
+@conditional
+def user_history(uid):
+    history = HISTORY.user_history(uid)
+    user = get_db().execute(db_queries.USER_QUERY, (uid,)).fetchone()
+    if not user and not history:
+        abort(404)
+    name = user['display_name'] if user else history[0]['display_name']
+
+    met = sum(1 for h in history if h['quota_met'])
+    subtitle = f"Месяцев в архиве: {len(history)}, норма набрана в {met}"
+    return HISTORY_PAGE.render(title=f"{name or 'без имени'}", subtitle=subtitle, history=history, archives=get_archives(), db_param=None, uid=uid)
+
+
+@app.route('/trends')
+@conditional
+def trends():
+    rows = HISTORY.trends()
+    return TRENDS_PAGE.render(title='мемберы × месяцы', subtitle=f'Архивов: {len(rows)}', trends=rows, archives=get_archives(), db_param=None)
+
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+LEADERBOARD_FIELDS = ('uid', 'display_name', 'liable', 'event_count', 'total_points', 'need_to_get', 'is_member')
+EVENT_FIELDS = ('message_id', 'guild_id', 'channel_id', 'channel_name', 'message_text', 'read_time', 'disband', 'points', 'hidden')
+
+# снежинки discord больше 2^53 - в json отдаем строками, как сам discord
+SNOWFLAKE_FIELDS = {'uid', 'message_id', 'guild_id', 'channel_id'}
+
+def api_item(row, fields):
+    return {f: str(row[f]) if f in SNOWFLAKE_FIELDS and row[f] is not None else row[f] for f in fields}
+
+def api_error(message, status=400):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+def api_limit():
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        return None
+    return min(max(limit, 1), API_MAX_PAGE_SIZE)
+
+def api_fields(allowed):
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+    fields = tuple(f.strip() for f in fields.split(',') if f.strip())
+    if not fields or any(f not in allowed for f in fields):
+        return None
+    return fields
+
+@app.route('/api/leaderboard')
+@conditional
+def api_leaderboard():
+    db_path, _ = resolve_db(request.args.get('db'))
+    limit = api_limit()
+    fields = api_fields(LEADERBOARD_FIELDS)
+    if limit is None or fields is None:
+        return api_error(f"limit must be a number, fields one of {','.join(LEADERBOARD_FIELDS)}")
+    # курсор: total_points:event_count:uid последней строки предыдущей страницы
+    after = (2 ** 62, 2 ** 62, 0)
+    if request.args.get('cursor'):
+        try:
+            points, count, uid = (int(x) for x in request.args['cursor'].split(':'))
+        except ValueError:
+            return api_error("bad cursor")
+        after = (points, count, -uid)
+
+    db = get_db(db_path)
+    if db_queries.has_table(db, 'USER_TOTALS'):
+        query = db_queries.LEADERBOARD_PAGE_QUERY
+    else:
+        query = db_queries.LEADERBOARD_AGGREGATE_PAGE_QUERY
+    rows = db.execute(query, (*after, limit)).fetchall()
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = f"{last['total_points']}:{last['event_count']}:{last['uid']}"
+    return jsonify({
+        'items': [api_item(row, fields) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+@app.route('/api/user/<int:uid>/events')
+@conditional
+def api_user_events(uid):
+    db_path, _ = resolve_db(request.args.get('db'))
+    limit = api_limit()
+    fields = api_fields(EVENT_FIELDS)
+    if limit is None or fields is None:
+        return api_error(f"limit must be a number, fields one of {','.join(EVENT_FIELDS)}")
+    # курсор: message_id последнего видимого события и сколько скрытых шло после него.
+    # id скрытых событий замаскированы в выдаче - в курсор они тоже не попадают
+    before, skip = 2 ** 63 - 1, 0
+    if request.args.get('cursor'):
+        try:
+            before, skip = (int(x) for x in request.args['cursor'].split(':'))
+        except ValueError:
+            return api_error("bad cursor")
+        if skip < 0:
+            return api_error("bad cursor")
+
+    db = get_db(db_path)
+    if db.execute(db_queries.USER_QUERY, (uid,)).fetchone() is None:
+        return api_error("user not found", 404)
+    rows = db.execute(db_queries.USER_EVENTS_PAGE_QUERY, (uid, before, limit, skip)).fetchall()
+    next_cursor = None
+    if len(rows) == limit:
+        for row in rows:
+            if row['hidden']:
+                skip += 1
+            else:
+                before, skip = row['message_id'], 0
+        next_cursor = f"{before}:{skip}"
+    return jsonify({
+        'items': [api_item(row, fields) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+SEARCH_PAGE_SIZE = 20
+
+def search_match(query):
+    # каждое слово - отдельная фраза с поиском по префиксу: синтаксис fts5 из ввода не проходит
+    terms = [t.replace('"', '""') for t in query.split()]
+    return " ".join(f'"{t}"*' for t in terms)
+
+def search_rows(db, query, limit, offset):
+    if not query.strip() or not db_queries.has_table(db, 'SEARCH_FTS'):
+        return []
+    return db.execute(db_queries.SEARCH_QUERY, (search_match(query), limit, offset)).fetchall()
+
+def search_count(db, query):
+    if not query.strip() or not db_queries.has_table(db, 'SEARCH_FTS'):
+        return 0
+    return db.execute(db_queries.SEARCH_COUNT_QUERY, (search_match(query),)).fetchone()[0]
+
+@app.route('/search')
+@conditional
+def search():
+    db_param = request.args.get('db')
+    db_path, history_title = resolve_db(db_param)
+    query = request.args.get('q', '')
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+
+    db = get_db(db_path)
+    # на строку больше - чтобы знать, есть ли следующая страница
+    rows = search_rows(db, query, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE)
+    results = rows[:SEARCH_PAGE_SIZE]
+
+    if query.strip():
+        subtitle = f'Найдено: {search_count(db, query)} | страница {page}'
+    else:
+        subtitle = 'Поиск по сообщениям контентов и веткам'
+    if history_title:
+        subtitle = f'Historical Data: {history_title} | {subtitle}'
+    return SEARCH_PAGE.render(title='поиск', subtitle=subtitle, query=query, results=results, page=page,
+                              has_next=len(rows) > SEARCH_PAGE_SIZE, archives=get_archives(), db_param=db_param)
+
+@app.route('/api/search')
+@conditional
+def api_search():
+    db_path, _ = resolve_db(request.args.get('db'))
+    query = request.args.get('q', '')
+    limit = api_limit()
+    if limit is None or not query.strip():
+        return api_error("q is required, limit must be a number")
+    # курсор: сколько результатов уже отдано (выдача отсортирована по релевантности)
+    try:
+        offset = max(int(request.args.get('cursor', 0)), 0)
+    except ValueError:
+        return api_error("bad cursor")
+    rows = search_rows(get_db(db_path), query, limit, offset)
+    fields = EVENT_FIELDS + ('in_thread', 'snippet')
+    items = [api_item(row, fields) for row in rows]
+    for item in items:
+        item['snippet'] = item['snippet'].replace('\x02', '').replace('\x03', '')
+    return jsonify({
+        'items': items,
+        'next_cursor': str(offset + limit) if len(rows) == limit else None,
+    })
+
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({'page_cache': PAGES.stats(), 'db_pool': POOL.stats()})
 
 
 from werkzeug.middleware.proxy_fix import ProxyFix
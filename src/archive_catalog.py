@@ -0,0 +1,89 @@
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from urllib.parse import quote
+
+ARCHIVE_NAME = re.compile(r'^([a-z]+)_(\d{4})$')
+MONTHS = {datetime(2000, m, 1).strftime("%B").lower(): m for m in range(1, 13)}
+
+
+class ArchiveCatalog:
+    # список архивов с метаданными. строится один раз и пересобирается, только
+    # когда меняется mtime папки (архив добавили, удалили или переименовали);
+    # метаданные файла пересчитываются, только если поменялись его размер или mtime
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.archives: list[dict] = []
+        self.by_name: dict[str, dict] = {}
+
+    def _metadata(self, name: str, month: str, year: str, path: str, st: os.stat_result) -> dict:
+        members = events = None
+        try:
+            conn = sqlite3.connect(f"file:{quote(path)}?mode=ro&immutable=1", uri=True)
+            try:
+                members = conn.execute("SELECT COUNT(*) FROM USERS WHERE is_member = 1").fetchone()[0]
+                events = conn.execute("SELECT COUNT(*) FROM EVENTS").fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+        return {
+            'file': name,
+            'name': f"{month.capitalize()} {year}",
+            'path': path,
+            'month': MONTHS.get(month),
+            'year': int(year),
+            'members': members,
+            'events': events,
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+        }
+
+    def _build(self):
+        archives = []
+        for f in os.listdir(self.archive_dir):
+            if not f.endswith('.db'):
+                continue
+            match = ARCHIVE_NAME.match(f[:-3])
+            if not match:
+                continue
+            name = f[:-3]
+            path = os.path.join(self.archive_dir, f)
+            st = os.stat(path)
+            cached = self.by_name.get(name)
+            if cached and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime_ns:
+                archives.append(cached)
+            else:
+                archives.append(self._metadata(name, match.group(1), match.group(2), path, st))
+        # новые месяцы сверху
+        archives.sort(key=lambda a: (a['year'], a['month'] or 0, a['file']), reverse=True)
+        self.archives = archives
+        self.by_name = {a['file']: a for a in archives}
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.archive_dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.dir_mtime:
+            return
+        with self.lock:
+            if mtime == self.dir_mtime:
+                return
+            if mtime is None:
+                self.archives, self.by_name = [], {}
+            else:
+                self._build()
+            self.dir_mtime = mtime
+
+    def list(self) -> list[dict]:
+        self.refresh()
+        return self.archives
+
+    def get(self, name: str) -> dict | None:
+        self.refresh()
+        return self.by_name.get(name)
@@ -0,0 +1,195 @@
+"""
+History across all monthly archives.
+Archives never change after they are written, so each one is aggregated
+once (per-user totals and per-month stats) into a sidecar index DB and
+re-read only when its size or mtime changes. Archives are ATTACHed in
+batches below SQLite's attach limit. Run directly to rebuild and print:
+    python archive_history.py [--rebuild]
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+from urllib.parse import quote
+import archive_catalog
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.path.join(SCRIPT_DIR, 'archives')
+# не в папке архивов: журнал индекса менял бы mtime папки, а от него зависят ETag страниц
+INDEX_PATH = os.environ.get("HISTORY_INDEX_PATH", os.path.join(SCRIPT_DIR, 'archive_history.db'))
+# SQLITE_MAX_ATTACHED по умолчанию 10
+ATTACH_BATCH = 8
+
+INDEX_SCHEMA = [
+    """
+CREATE TABLE IF NOT EXISTS ARCHIVE_INDEX (
+    archive TEXT PRIMARY KEY,
+    name TEXT,
+    year INTEGER,
+    month INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    members INTEGER,
+    active_users INTEGER,
+    events INTEGER,
+    disbanded INTEGER,
+    total_points INTEGER,
+    quota_met INTEGER,
+    error TEXT
+)
+""",
+    """
+CREATE TABLE IF NOT EXISTS ARCHIVE_TOTALS (
+    uid INTEGER,
+    archive TEXT,
+    display_name TEXT,
+    event_count INTEGER,
+    total_points INTEGER,
+    need_to_get INTEGER,
+    is_member INTEGER,
+    PRIMARY KEY (uid, archive)
+) WITHOUT ROWID
+""",
+    "CREATE INDEX IF NOT EXISTS idx_archive_totals_archive ON ARCHIVE_TOTALS(archive)",
+]
+
+# тот же агрегат, что и LEADERBOARD_AGGREGATE_SELECT, но по приаттаченной базе
+ARCHIVE_TOTALS_SQL = """
+INSERT INTO ARCHIVE_TOTALS (uid, archive, display_name, event_count, total_points, need_to_get, is_member)
+SELECT u.uid, ?,
+       COALESCE(NULLIF(u.server_username, ''), u.global_username),
+       COUNT(DISTINCT CASE WHEN e.disband != 1 THEN e.message_id END),
+       COALESCE(SUM(CASE WHEN e.disband != 1 THEN e.points ELSE 0 END), 0),
+       u.need_to_get,
+       u.is_member
+  FROM {db}.USERS u
+  LEFT JOIN {db}.EVENTS_TO_USERS etu ON etu.ds_uid = u.uid
+  LEFT JOIN {db}.EVENTS e ON e.message_id = etu.message_id
+ WHERE COALESCE(NULLIF(u.server_username, ''), u.global_username) != 'D9dka'
+ GROUP BY u.uid
+"""
+ARCHIVE_EVENTS_SQL = """
+SELECT COUNT(*), COALESCE(SUM(disband = 1), 0), COALESCE(SUM(CASE WHEN disband != 1 THEN points ELSE 0 END), 0)
+  FROM {db}.EVENTS
+"""
+ARCHIVE_USERS_SQL = """
+SELECT COALESCE(SUM(is_member = 1), 0),
+       COALESCE(SUM(event_count > 0), 0),
+       COALESCE(SUM(is_member = 1 AND total_points >= need_to_get), 0)
+  FROM ARCHIVE_TOTALS
+ WHERE archive = ?
+"""
+UPSERT_INDEX_SQL = """
+INSERT OR REPLACE INTO ARCHIVE_INDEX
+    (archive, name, year, month, size, mtime, members, active_users, events, disbanded, total_points, quota_met, error)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+USER_HISTORY_QUERY = """
+SELECT i.archive, i.name, i.year, i.month, t.display_name, t.event_count, t.total_points, t.need_to_get, t.is_member,
+       t.total_points >= t.need_to_get AS quota_met
+  FROM ARCHIVE_TOTALS t
+  JOIN ARCHIVE_INDEX i ON i.archive = t.archive
+ WHERE t.uid = ?
+ ORDER BY i.year DESC, i.month DESC
+"""
+TRENDS_QUERY = """
+SELECT archive, name, year, month, members, active_users, events, disbanded, total_points, quota_met,
+       CASE WHEN active_users > 0 THEN ROUND(1.0 * total_points / active_users, 1) END AS points_per_active
+  FROM ARCHIVE_INDEX
+ WHERE error IS NULL
+ ORDER BY year DESC, month DESC
+"""
+
+
+class ArchiveHistory:
+    # индекс сверяется с каталогом на каждом запросе, но каталог пересобирается
+    # только при изменении папки, так что без новых архивов это сравнение словарей
+    def __init__(self, catalog: archive_catalog.ArchiveCatalog, index_path: str = INDEX_PATH):
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(f"file:{quote(index_path)}", uri=True, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        for statement in INDEX_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self.versions = {
+            row['archive']: (row['size'], row['mtime'])
+            for row in self.conn.execute("SELECT archive, size, mtime FROM ARCHIVE_INDEX")
+        }
+
+    def _aggregate(self, batch: list[dict]):
+        for i, archive in enumerate(batch):
+            self.conn.execute(f"ATTACH DATABASE ? AS a{i}", (f"file:{quote(archive['path'])}?mode=ro&immutable=1",))
+        try:
+            with self.conn:
+                for i, archive in enumerate(batch):
+                    self.conn.execute("DELETE FROM ARCHIVE_TOTALS WHERE archive = ?", (archive['file'],))
+                    error = None
+                    events = disbanded = points = members = active = quota_met = None
+                    try:
+                        self.conn.execute(ARCHIVE_TOTALS_SQL.format(db=f"a{i}"), (archive['file'],))
+                        events, disbanded, points = self.conn.execute(ARCHIVE_EVENTS_SQL.format(db=f"a{i}")).fetchone()
+                        members, active, quota_met = self.conn.execute(ARCHIVE_USERS_SQL, (archive['file'],)).fetchone()
+                    except sqlite3.Error as e:
+                        # битый или слишком старый архив не должен ронять остальные
+                        error = str(e)
+                        self.conn.execute("DELETE FROM ARCHIVE_TOTALS WHERE archive = ?", (archive['file'],))
+                    self.conn.execute(UPSERT_INDEX_SQL, (
+                        archive['file'], archive['name'], archive['year'], archive['month'],
+                        archive['size'], archive['mtime'],
+                        members, active, events, disbanded, points, quota_met, error,
+                    ))
+        finally:
+            for i in range(len(batch)):
+                self.conn.execute(f"DETACH DATABASE a{i}")
+
+    def refresh(self, force: bool = False) -> int:
+        # возвращает, сколько архивов пересчитано
+        archives = self.catalog.list()
+        current = {a['file']: (a['size'], a['mtime']) for a in archives}
+        if current == self.versions and not force:
+            return 0
+        with self.lock:
+            stale = [a for a in archives if force or self.versions.get(a['file']) != current[a['file']]]
+            removed = [name for name in self.versions if name not in current]
+            for start in range(0, len(stale), ATTACH_BATCH):
+                self._aggregate(stale[start:start + ATTACH_BATCH])
+            if removed:
+                with self.conn:
+                    for name in removed:
+                        self.conn.execute("DELETE FROM ARCHIVE_TOTALS WHERE archive = ?", (name,))
+                        self.conn.execute("DELETE FROM ARCHIVE_INDEX WHERE archive = ?", (name,))
+            self.versions = current
+            return len(stale)
+
+    def user_history(self, uid: int) -> list[sqlite3.Row]:
+        self.refresh()
+        with self.lock:
+            return self.conn.execute(USER_HISTORY_QUERY, (uid,)).fetchall()
+
+    def trends(self) -> list[sqlite3.Row]:
+        self.refresh()
+        with self.lock:
+            return self.conn.execute(TRENDS_QUERY).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    history = ArchiveHistory(archive_catalog.ArchiveCatalog(ARCHIVE_DIR))
+    try:
+        updated = history.refresh(force='--rebuild' in sys.argv)
+        print(f"{INDEX_PATH}: {updated} archives aggregated")
+        for row in history.trends():
+            print(f"    {row['name']}: {row['members']} members, {row['active_users']} active, "
+                  f"{row['events']} events ({row['disbanded']} disbanded), {row['total_points']} points, "
+                  f"quota met by {row['quota_met']}")
+    finally:
+        history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Precomputed snapshots of monthly archives for the website.
+An archive never changes, so its leaderboard and every user's event list
+are rendered to JSON once and packed into <archive>.snap next to it:
+    header | index of (uid, offset, length) sorted by uid | JSON blobs
+The site maps the file with mmap and finds a user by binary search over
+the index, without opening SQLite. Run directly to (re)build snapshots:
+    python archive_snapshot.py [--rebuild]
+"""
+
+import os
+import sys
+import mmap
+import json
+import struct
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+import archive_catalog
+import db_queries
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.path.join(SCRIPT_DIR, 'archives')
+
+MAGIC = b'SNGKSNP1'
+VERSION = 1
+# magic, версия, пользователей, размер и mtime_ns архива, смещение и длина таблицы лидеров
+HEADER = struct.Struct('<8sIIqqQQ')
+# uid, смещение и длина json пользователя
+INDEX_ENTRY = struct.Struct('<qQI')
+
+LEADERBOARD_FIELDS = ('uid', 'display_name', 'liable', 'event_count', 'total_points', 'need_to_get', 'is_member')
+EVENT_FIELDS = ('message_id', 'guild_id', 'channel_id', 'channel_name', 'message_text', 'read_time', 'disband', 'points', 'hidden')
+
+
+def snapshot_path(archive_path: str) -> str:
+    return archive_path[:-3] + '.snap' if archive_path.endswith('.db') else archive_path + '.snap'
+
+
+def _blob(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _user_events(events: sqlite3.Cursor):
+    # события идут по ds_uid подряд - отдаем их группами (uid, [события])
+    uid, group = None, []
+    for row in events:
+        if row[0] != uid:
+            if group:
+                yield uid, group
+            uid, group = row[0], []
+        group.append(dict(zip(EVENT_FIELDS, row[1:])))
+    if group:
+        yield uid, group
+
+
+def write_snapshot(archive_path: str, path: str = None) -> str:
+    path = path or snapshot_path(archive_path)
+    st = os.stat(archive_path)
+    conn = sqlite3.connect(f"file:{quote(archive_path)}?mode=ro&immutable=1", uri=True)
+    tmp_path = path + '.tmp'
+    try:
+        if db_queries.has_table(conn, 'USER_TOTALS'):
+            leaderboard = conn.execute(db_queries.LEADERBOARD_QUERY).fetchall()
+        else:
+            leaderboard = conn.execute(db_queries.LEADERBOARD_AGGREGATE_QUERY).fetchall()
+        users = conn.execute(db_queries.SNAPSHOT_USERS_QUERY).fetchall()
+        events = _user_events(conn.execute(db_queries.SNAPSHOT_EVENTS_QUERY))
+
+        index = []
+        with open(tmp_path, 'wb') as f:
+            # место под заголовок и индекс известно заранее - блобы пишутся потоком следом
+            f.seek(HEADER.size + INDEX_ENTRY.size * len(users))
+            leaderboard_offset = f.tell()
+            leaderboard_length = f.write(_blob([dict(zip(LEADERBOARD_FIELDS, row)) for row in leaderboard]))
+
+            pending = next(events, None)
+            for uid, display_name in users:
+                user_events = []
+                # события без пользователя в USERS пропускаем, как и джойн на сайте
+                while pending and pending[0] < uid:
+                    pending = next(events, None)
+                if pending and pending[0] == uid:
+                    user_events = pending[1]
+                    pending = next(events, None)
+                offset = f.tell()
+                length = f.write(_blob({
+                    'user': {'uid': uid, 'display_name': display_name},
+                    'event_count': len(user_events),
+                    'events': user_events,
+                }))
+                index.append((uid, offset, length))
+
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, len(index), st.st_size, st.st_mtime_ns, leaderboard_offset, leaderboard_length))
+            for entry in index:
+                f.write(INDEX_ENTRY.pack(*entry))
+        os.replace(tmp_path, path)
+    finally:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+class ArchiveSnapshot:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.user_count, self.source_size, self.source_mtime, self.lb_offset, self.lb_length = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError(f"{path} is not a v{VERSION} archive snapshot")
+        # запросы, читающие снапшот прямо сейчас, и признак, что его уже заменили (см. SnapshotStore)
+        self.readers = 0
+        self.retired = False
+
+    def matches(self, archive: dict) -> bool:
+        return (self.source_size, self.source_mtime) == (archive['size'], archive['mtime'])
+
+    def _load(self, offset: int, length: int):
+        return json.loads(self.mm[offset:offset + length])
+
+    def leaderboard(self) -> list[dict]:
+        return self._load(self.lb_offset, self.lb_length)
+
+    def user(self, uid: int) -> dict | None:
+        # бинарный поиск по индексу прямо в отображенном файле
+        lo, hi = 0, self.user_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_uid, offset, length = INDEX_ENTRY.unpack_from(self.mm, HEADER.size + mid * INDEX_ENTRY.size)
+            if entry_uid == uid:
+                return self._load(offset, length)
+            if entry_uid < uid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def close(self):
+        self.mm.close()
+
+
+class SnapshotStore:
+    # открытые снапшоты архивов; снапшот, собранный не с текущей версии архива,
+    # не используется - сайт тогда идет в sqlite. замененный снапшот закрывается,
+    # как только его отпустит последний читающий запрос
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots: dict[str, tuple[int, ArchiveSnapshot | None]] = {}
+
+    def _retire(self, snapshot: ArchiveSnapshot):
+        snapshot.retired = True
+        if snapshot.readers == 0:
+            snapshot.close()
+
+    def _current(self, archive: dict) -> ArchiveSnapshot | None:
+        # вызывается под self.lock
+        path = snapshot_path(archive['path'])
+        try:
+            version = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            version = None
+        cached = self.snapshots.get(path)
+        if cached and cached[0] == version:
+            snapshot = cached[1]
+        else:
+            snapshot = None
+            if version is not None:
+                try:
+                    snapshot = ArchiveSnapshot(path)
+                except (OSError, ValueError, struct.error):
+                    snapshot = None
+            self.snapshots[path] = (version, snapshot)
+            if cached and cached[1]:
+                self._retire(cached[1])
+        if snapshot is None or not snapshot.matches(archive):
+            return None
+        return snapshot
+
+    @contextmanager
+    def use(self, archive: dict | None):
+        # снапшот архива (или None) на время with; пока он в руках, его mmap не закрывается
+        with self.lock:
+            snapshot = self._current(archive) if archive else None
+            if snapshot:
+                snapshot.readers += 1
+        try:
+            yield snapshot
+        finally:
+            if snapshot:
+                with self.lock:
+                    snapshot.readers -= 1
+                    if snapshot.retired and snapshot.readers == 0:
+                        snapshot.close()
+
+    def close(self):
+        with self.lock:
+            for _, snapshot in self.snapshots.values():
+                if snapshot:
+                    self._retire(snapshot)
+            self.snapshots = {}
+
+
+def main():
+    catalog = archive_catalog.ArchiveCatalog(ARCHIVE_DIR)
+    for archive in catalog.list():
+        path = snapshot_path(archive['path'])
+        if os.path.exists(path) and '--rebuild' not in sys.argv:
+            try:
+                snapshot = ArchiveSnapshot(path)
+                fresh = snapshot.matches(archive)
+                snapshot.close()
+                if fresh:
+                    continue
+            except (OSError, ValueError, struct.error):
+                pass
+        write_snapshot(archive['path'], path)
+        print(f"{path}: {os.path.getsize(path)} bytes")
+
+
+if __name__ == "__main__":
+    main()
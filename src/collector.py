@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+import tempfile
+import asyncio
 import discord
 from datetime import datetime, timedelta, timezone
 import dotenv
@@ -8,8 +11,8 @@ import common
 import CONSTANTS
 import db_worker as dbw
 import logger
-import pandas as pd
-from io import BytesIO
+import reactions
+import report_export
 dotenv.load_dotenv()
 
 TOKEN = os.getenv("DISCORD_TOKEN")
@@ -17,10 +20,58 @@ TOKEN = os.getenv("DISCORD_TOKEN")
 intents = discord.Intents.none()
 intents.guilds = True
 intents.message_content = True
+intents.members = True
 client = discord.Client(intents=intents)
 
 db_worker = dbw.DBWorker()
+reaction_dispatcher = reactions.ReactionDispatcher(client)
+member_snapshot = common.MemberSnapshot()
 lgr = logger.get_logger("collector")
+# окна пересчета месяца (ставит monthly_results): каждый непрерывный кусок
+# пропущенных дней обходится отдельно. None - обычный запуск от чекпоинта
+SCAN_WINDOWS: list[tuple[datetime, datetime]] | None = None
+
+def scan_window(channel_id: int) -> tuple[datetime | discord.Object, datetime]:
+    now = datetime.now(timezone.utc)
+    try:
+        before = datetime.fromisoformat(os.getenv("SENGOKU_BEFORE", "")) if os.getenv("SENGOKU_BEFORE") else (now - timedelta(hours=CONSTANTS.TO_HOURS))
+    except ValueError:
+        before = now - timedelta(hours=CONSTANTS.TO_HOURS)
+    # явно заданное окно (пересчет месяца) важнее чекпоинта
+    if os.getenv("SENGOKU_AFTER"):
+        try:
+            return datetime.fromisoformat(os.getenv("SENGOKU_AFTER")), before
+        except ValueError:
+            pass
+    # продолжаем с последнего записанного сообщения, пропущенные дни догоняются сами
+    last_message_id = db_worker.get_checkpoint(channel_id)
+    if last_message_id:
+        return discord.Object(id=last_message_id), before
+    return now - timedelta(hours=CONSTANTS.FROM_HOURS), before
+
+async def build_event(m: discord.Message, points: int, hide: bool) -> datatypes.Event:
+    event = datatypes.Event(
+        message_id=m.id,
+        author=await common.get_user_by_id(client, m.guild.id, m.author.id, db_worker, member_snapshot),
+        message_text=m.content,
+        read_time=m.created_at,
+        mentioned_users=await common.users_by_message(m, client, db_worker, member_snapshot),
+        guild_id=m.guild.id if m.guild else None,
+        hidden=hide
+    )
+    if m.thread:
+        async for mm in m.thread.history(limit=None, oldest_first=True):
+            bm = datatypes.BranchMessage(
+                message_id=mm.id,
+                message_text=mm.content,
+                read_time=mm.created_at,
+                author_id=mm.author.id
+            )
+            event.branch_messages.append(bm)
+    event.channel_id = m.channel.id
+    event.channel_name = m.channel.name
+    common.apply_event_rules(event, points)
+    return event
 
 async def analyze_channel(channel_id: int, points: int, hide=False, after: datetime = None, before: datetime = None):
     try:
@@ -30,61 +81,102 @@ async def analyze_channel(channel_id: int, points: int, hide=False, after: datet
         if channel is None:
             channel = await client.fetch_channel(channel_id)
 
-        now = datetime.now(timezone.utc)
-        try:
-            after = datetime.fromisoformat(os.getenv("SENGOKU_AFTER", "")) if os.getenv("SENGOKU_AFTER") else (now - timedelta(hours=CONSTANTS.FROM_HOURS))
-        except ValueError:
-            after = now - timedelta(hours=CONSTANTS.FROM_HOURS)
-        try:
-            before = datetime.fromisoformat(os.getenv("SENGOKU_BEFORE", "")) if os.getenv("SENGOKU_BEFORE") else (now - timedelta(hours=CONSTANTS.TO_HOURS))
-        except ValueError:
-            before = now - timedelta(hours=CONSTANTS.TO_HOURS)
-        # after = datetime(2025, 11, 1, 0, 1, tzinfo=timezone.utc)
-        # before = datetime(2025, 10, 16, 0, 1, tzinfo=timezone.utc)
+        if after is None or before is None:
+            after, before = scan_window(channel_id)
         lgr.info(f"analyzing channel {channel_id} from {after} to {before}")
-        n = 0
-        async for m in channel.history(limit=None, after=after, before=before, oldest_first=True):
-            event = datatypes.Event(
-                message_id=m.id,
-                author=await common.get_user_by_id(client, m.guild.id, m.author.id, db_worker),
-                message_text=m.content,
-                read_time=m.created_at,
-                mentioned_users=await common.users_by_message(m, client, db_worker),
-                guild_id=m.guild.id if m.guild else None,
-                hidden=hide
-            )
-            event.disband = int(common.check_disband(event.message_text))
-            if m.thread:
-                async for mm in m.thread.history(limit=None, oldest_first=True):
-                    bm = datatypes.BranchMessage(
-                        message_id=mm.id,
-                        message_text=mm.content,
-                        read_time=mm.created_at
-                    )
-                    event.branch_messages.append(bm)
-                    if common.check_disband(bm.message_text) and mm.author.id == m.author.id:
-                        event.disband = 1
-            event.channel_id = m.channel.id
-            event.channel_name = m.channel.name
-            event.points = common.points_by_event(event, points)
-            if event in CONSTANTS.HIDDEN and common.check_for_treasury(m):
-                event.points = CONSTANTS.TREASURY_POINTS
-            n += 1
-            if len(event.mentioned_users) < CONSTANTS.MIN_USERS:
-                event.disband = 1
-            db_worker.add_event(event)
+
+        # конвейер: history -> воркеры (ветки, упоминания) -> запись по порядку.
+        # в очереди лежат задачи в порядке сообщений, так что запись идет в том же
+        # порядке, а память ограничена размером очереди, а не историей канала
+        workers = asyncio.Semaphore(max(1, CONSTANTS.THREAD_WORKERS))
+        pending = asyncio.Queue(maxsize=max(1, CONSTANTS.PIPELINE_QUEUE_SIZE))
+
+        async def build(m: discord.Message):
+            # ошибка одного сообщения не должна останавливать канал - отдаем ее писателю
+            async with workers:
+                try:
+                    return m, await build_event(m, points, hide)
+                except Exception as e:
+                    return m, e
+
+        async def produce():
             try:
-                if CONSTANTS.REACT_TO_MESSAGES:
-                    lgr.info(f"adding reaction to message {m.id}, disband={event.disband}")
-                    await m.add_reaction(CONSTANTS.REACTION_NO if event.disband == 1 else CONSTANTS.REACTION_YES)
+                async for m in channel.history(limit=None, after=after, before=before, oldest_first=True):
+                    await pending.put(asyncio.create_task(build(m)))
             except Exception as e:
-                lgr.error(f"Failed to add reaction to message {m.id}: {e}")
-        lgr.info(f"analyzed {n} messages in channel {channel_id}")
+                await pending.put(e)
+                return
+            await pending.put(None)
+
+        n = skipped = 0
+        producer = asyncio.create_task(produce())
+        try:
+            with db_worker.batch(CONSTANTS.DB_BATCH_SIZE) as batch:
+                while True:
+                    item = await pending.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    m, event = await item
+                    if isinstance(event, Exception):
+                        # иначе чекпоинт навсегда встал бы перед этим сообщением
+                        # и каждый следующий запуск сканировал бы канал отсюда
+                        lgr.error(f"skipping message {m.id} in channel {channel_id}: {event}")
+                        batch.advance(channel_id, m.id)
+                        skipped += 1
+                        continue
+                    n += 1
+                    batch.add(event)
+                    if CONSTANTS.REACT_TO_MESSAGES:
+                        reaction_dispatcher.submit(m, event.disband == 1)
+        finally:
+            # продюсер может висеть на pending.put - отменяем и дожидаемся его
+            # вместе с недобранными задачами, чтобы их ошибки не терялись
+            producer.cancel()
+            leftover = [producer]
+            while not pending.empty():
+                item = pending.get_nowait()
+                if isinstance(item, asyncio.Task):
+                    item.cancel()
+                    leftover.append(item)
+            for result in await asyncio.gather(*leftover, return_exceptions=True):
+                if isinstance(result, Exception):
+                    lgr.warning(f"pipeline task for channel {channel_id} failed: {result}")
+        lgr.info(f"analyzed {n} messages in channel {channel_id}" + (f", skipped {skipped} failed" if skipped else ""))
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         lgr.error(f"Error analyzing channel {channel_id}: {e}, {exc_type}, {fname}, {exc_tb.tb_lineno}")
 
+async def collect_channels():
+    # каналы сканируются параллельно, но не больше CHANNEL_CONCURRENCY за раз,
+    # чтобы не упираться в рейтлимиты discord
+    semaphore = asyncio.Semaphore(max(1, CONSTANTS.CHANNEL_CONCURRENCY))
+
+    async def run(channel_id: int, points: int, hide: bool) -> float:
+        async with semaphore:
+            started = time.monotonic()
+            for after, before in SCAN_WINDOWS or [(None, None)]:
+                await analyze_channel(channel_id, points, hide=hide, after=after, before=before)
+            elapsed = time.monotonic() - started
+            lgr.info(f"analyzed {'hidden ' if hide else ''}channel {channel_id} in {elapsed:.1f}s")
+            return elapsed
+
+    started = time.monotonic()
+    jobs = [run(ch, CONSTANTS.CHANNELS[ch], False) for ch in CONSTANTS.CHANNELS]
+    jobs += [run(ch, CONSTANTS.HIDDEN[ch], True) for ch in CONSTANTS.HIDDEN]
+    durations = await asyncio.gather(*jobs)
+    wall_time = time.monotonic() - started
+    sequential_time = sum(durations)
+    lgr.info(
+        f"collected {len(durations)} channels in {wall_time:.1f}s "
+        f"(sequential {sequential_time:.1f}s, saved {sequential_time - wall_time:.1f}s, "
+        f"concurrency {CONSTANTS.CHANNEL_CONCURRENCY})"
+    )
+    users = db_worker.users
+    lgr.info(f"user cache: {len(users)} users, {users.hits} hits, {users.misses} misses, {users.writes} writes, {users.skipped_writes} skipped writes")
+
 async def analyze_usefulness_points(after: datetime = None, before: datetime = None):
     # Placeholder for future implementation
     pass
@@ -93,27 +185,30 @@ async def analyze_usefulness_points(after: datetime = None, before: datetime = N
 async def on_ready():
     lgr.info(f"logged in as {client.user}")
     try:
-        for ch in CONSTANTS.CHANNELS:
-            await analyze_channel(ch, CONSTANTS.CHANNELS[ch], hide=False)
-            lgr.info(f"analyzed channel {ch}")
-        for ch in CONSTANTS.HIDDEN:
-            await analyze_channel(ch, CONSTANTS.HIDDEN[ch], hide=True)
-            lgr.info(f"analyzed hidden channel {ch}")
+        if CONSTANTS.REPORT_ONLY:
+            lgr.info("report only: channels are not scanned")
+        else:
+            for guild_id in CONSTANTS.GUILD_IDS:
+                try:
+                    await member_snapshot.load(client, guild_id)
+                except Exception as e:
+                    lgr.error(f"Failed to load member snapshot for guild {guild_id}, falling back to REST lookups: {e}")
+            lgr.info(f"member snapshot: {len(member_snapshot)} members")
+            await collect_channels()
         if CONSTANTS.MONTHLY_CALC:
             channel = client.get_channel(CONSTANTS.REPORT_CHANNEL_ID)
-            df = db_worker.load_database_as_dataframe()
-
-            with BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                    df.to_excel(writer, index=False, sheet_name='Data')
-                buffer.seek(0)
-                excel_file = discord.File(fp=buffer, filename="database.xlsx")
-
-            await channel.send("файлик с посещениями:", file=excel_file)
+            # отчет пишется потоком во временные файлы, а не в память целиком
+            with tempfile.TemporaryDirectory() as tmp:
+                paths = report_export.export_report(db_worker.conn, tmp, CONSTANTS.REPORT_FORMAT)
+                paths = report_export.fit_for_upload(paths, CONSTANTS.DISCORD_ATTACHMENT_LIMIT)
+                for batch in report_export.upload_batches(paths):
+                    await channel.send("файлик с посещениями:", files=[discord.File(path) for path in batch])
             
     except Exception as e:
         import traceback; traceback.print_exc()
     finally:
+        await reaction_dispatcher.close()
+        db_worker.close()
         await client.close()
         lgr.info("All done, client closed")
 
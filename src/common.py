@@ -2,6 +2,7 @@ import discord
 import CONSTANTS
 import datatypes
 import re
+import copy
 import datetime
 import db_worker as dbw
 from datetime import date, timedelta
@@ -22,72 +23,120 @@ def calculate_need_to_get(join_date: datetime.datetime) -> int:
     return need_to_get
 
 
-async def get_user_by_id(client: discord.Client, guild_id: int, user_id: int, db_worker: dbw.DBWorker = None) -> datatypes.User:
-    user = db_worker.get_user(user_id) if db_worker else None
-    if user:
-        return user
-    guild = client.get_guild(guild_id)
-    if guild is None:
-        try:
-            guild = await client.fetch_guild(guild_id)  # редко нужно
-        except Exception:
-            guild = None
-    need_to_get = 45
+def user_from_member(member: discord.Member, global_username: str = None) -> datatypes.User:
+    liable = 1
+    user_roles = [r.name for r in member.roles if r.name != "@everyone"]
+    for admin_role in CONSTANTS.ADMIN_ROLES:
+        if admin_role in user_roles:
+            liable = CONSTANTS.ADMIN_ROLES[admin_role]
+            break
+    return datatypes.User(
+        uuid=member.id,
+        server_username=member.display_name,
+        global_username=global_username or member.name,
+        liable=liable,
+        is_member=1,
+        need_to_get=calculate_need_to_get(member.joined_at),
+        join_date=member.joined_at,
+        roles=",".join(user_roles)
+    )
+
+
+class MemberSnapshot:
+    # все участники гильдии, загруженные один раз на старте чанками через gateway,
+    # чтобы упоминания резолвились из памяти, а не REST-запросом на каждого
+    def __init__(self):
+        self.users: dict[int, datatypes.User] = {}
+        self.guild_ids: set[int] = set()
+
+    async def load(self, client: discord.Client, guild_id: int):
+        guild = client.get_guild(guild_id)
+        if guild is None:
+            guild = await client.fetch_guild(guild_id)
+        members = await guild.chunk(cache=True)
+        for member in members:
+            self.users[member.id] = user_from_member(member)
+        self.guild_ids.add(guild_id)
+
+    def get(self, user_id: int) -> datatypes.User | None:
+        return self.users.get(user_id)
+
+    def has_guild(self, guild_id: int) -> bool:
+        return guild_id in self.guild_ids
+
+    def __len__(self):
+        return len(self.users)
+
+
+async def get_user_by_id(client: discord.Client, guild_id: int, user_id: int, db_worker: dbw.DBWorker = None, snapshot: MemberSnapshot = None) -> datatypes.User:
+    stored = db_worker.get_user(user_id) if db_worker else None
+    if snapshot:
+        user = snapshot.get(user_id)
+        if user:
+            if stored:
+                # visible и timeout ставятся вручную в базе - берем их из сохраненной строки
+                user = copy.copy(user)
+                user.visible = stored.visible
+                user.timeout = stored.timeout
+            return user
+    if stored:
+        return stored
     member = None
-    if guild:
-        member = guild.get_member(user_id)
-        if member is None:
+    # если снапшот гильдии загружен, а человека в нем нет - он не участник,
+    # в гильдию за ним не ходим
+    if not (snapshot and snapshot.has_guild(guild_id)):
+        guild = client.get_guild(guild_id)
+        if guild is None:
             try:
-                member = await guild.fetch_member(user_id)
-            except discord.NotFound:
-                member = None
-            except discord.Forbidden:
-                member = None
-    liable = 1
-    is_member = 0
-    user_roles = []
-    if member:
-        need_to_get = calculate_need_to_get(member.joined_at)
-        is_member = 1
-        user_roles = [r.name for r in member.roles if r.name != "@everyone"]
-        for admin_role in CONSTANTS.ADMIN_ROLES:
-            if admin_role in user_roles:
-                liable = CONSTANTS.ADMIN_ROLES[admin_role]
-                break
+                guild = await client.fetch_guild(guild_id)  # редко нужно
+            except Exception:
+                guild = None
+        if guild:
+            member = guild.get_member(user_id)
+            if member is None:
+                try:
+                    member = await guild.fetch_member(user_id)
+                except discord.NotFound:
+                    member = None
+                except discord.Forbidden:
+                    member = None
     try:
         user = await client.fetch_user(user_id)
     except Exception:
         user = None
-    
-    user = datatypes.User(
+
+    if member:
+        return user_from_member(member, user.name if user else None)
+    return datatypes.User(
         uuid=user_id,
-        server_username=member.display_name if member else None,
+        server_username=None,
         global_username=user.name if user else None,
-        liable=liable,
-        is_member=is_member,
-        need_to_get=need_to_get if member else 0,
-        join_date=member.joined_at if member else None,
-        roles=",".join(user_roles)
+        liable=1,
+        is_member=0,
+        need_to_get=0,
+        join_date=None,
+        roles=""
     )
-    return user
 
 
-async def users_by_message(message: discord.Message, client: discord.Client, db_worker: dbw.DBWorker = None) -> list[datatypes.User]:
+async def users_by_message(message: discord.Message, client: discord.Client, db_worker: dbw.DBWorker = None, snapshot: MemberSnapshot = None) -> list[datatypes.User]:
     if '<@' in message.content:
         mentioned_ids = set(int(m) for m in re.findall(CONSTANTS.NAME_LINE, message.content))
         users = []
         for uid in mentioned_ids:
-            user = await get_user_by_id(client, message.guild.id, uid, db_worker)
+            user = await get_user_by_id(client, message.guild.id, uid, db_worker, snapshot)
             users.append(user)
         return users
     return []
 
+WORD_RE = re.compile(r"\w+")
+
+def has_keyword(message: str, keywords: set[str]) -> bool:
+    # сравниваем целые слова: по подстроке 'dis' нашлось бы в 'discord', 'диз' - в 'дизайн'
+    return any(word in keywords for word in WORD_RE.findall(message.lower()))
+
 def check_disband(message: str) -> bool:
-    text = message.lower()
-    for word in text:
-        if word in CONSTANTS.DISBAND_MESSAGES:
-            return True
-    return False
+    return has_keyword(message, CONSTANTS.DISBAND_MESSAGES)
 
 def points_by_event(event: datatypes.Event, points: int) -> int:
     for name in CONSTANTS.GROUP_MAP_NAMES:
@@ -95,19 +144,31 @@ def points_by_event(event: datatypes.Event, points: int) -> int:
             return CONSTANTS.POINTS_GROUP_MAP
     return CONSTANTS.CHANNELS.get(event.channel_id, points)
 
-def check_for_treasury(message: discord.Message) -> bool:
-    text = message.content.lower()
-    for word in text:
-        if word in CONSTANTS.TREASURY_MESSAGES:
+def check_treasury(message: str) -> bool:
+    return has_keyword(message, CONSTANTS.TREASURY_MESSAGES)
+
+def check_for_treasury(event: datatypes.Event) -> bool:
+    # ветка уже собрана в event.branch_messages - в discord за ней не ходим
+    if check_treasury(event.message_text):
+        return True
+    for bm in event.branch_messages:
+        if bm.message_text and check_treasury(bm.message_text):
             return True
-    if message.thread:
-        for mm in message.thread.history(limit=None, oldest_first=True):
-            if mm.content:
-                text = mm.content.lower()
-                for word in text:
-                    if word in CONSTANTS.TREASURY_MESSAGES:
-                        return True
     return False
 
+def apply_event_rules(event: datatypes.Event, points: int):
+    # правила disband/очков по уже собранному событию; общие для сборщика
+    # и офлайн-пересчета месяца (recompute.py), чтобы они не разъезжались
+    author_id = event.author.uuid if event.author else None
+    event.disband = int(check_disband(event.message_text))
+    for bm in event.branch_messages:
+        if check_disband(bm.message_text) and bm.author_id == author_id:
+            event.disband = 1
+    event.points = points_by_event(event, points)
+    if event.channel_id in CONSTANTS.HIDDEN and check_for_treasury(event):
+        event.points = CONSTANTS.TREASURY_POINTS
+    if len(event.mentioned_users) < CONSTANTS.MIN_USERS:
+        event.disband = 1
+
 def calculate_points_to_get(join_date):
     pass
\ No newline at end of file
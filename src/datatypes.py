@@ -1,7 +1,5 @@
 import datetime
-import os
-
-from monthly_results import SCRIPT_DIR
+import maintenance
 class User:
     uuid: int
     server_username: str
@@ -41,12 +39,15 @@ class BranchMessage:
     message_id: int
     message_text: str
     read_time: datetime.datetime
+    author_id: int | None = None
     def __init__(self,
                 message_id: int,
                 message_text: str,
-                read_time: datetime.datetime = None):
+                read_time: datetime.datetime = None,
+                author_id: int | None = None):
         self.message_id = message_id
         self.message_text = message_text
+        self.author_id = author_id
         if read_time:
             self.read_time = read_time
         else:
@@ -95,22 +96,12 @@ class Event:
 
 
 class Website():
-    def __init__(self, SCRIPT_DIR=os.path.dirname(os.path.abspath(__file__)), PM2_WEBSITE_NAME=os.getenv("PM2_WEBSITE_NAME", "sengoku-website")):
-        with open(os.path.join(os.path.dirname(SCRIPT_DIR), ".env")) as f:
-            lines = f.readlines()
-            if "TECHNICAL_TIMEOUT" in lines[-1]:
-                lines = lines[:-1]
-            self.env_content = "".join(lines)
-        self.PM2_WEBSITE_NAME = PM2_WEBSITE_NAME
-
-    def _set_technical_timeout(self, timeout_value):
-        with open(os.path.join(os.path.dirname(SCRIPT_DIR), ".env"), 'w') as f:
-            f.write(self.env_content + f"\nTECHNICAL_TIMEOUT='{timeout_value}'")
+    # включает и выключает режим техработ сайта без рестарта (см. maintenance.py)
+    def __init__(self, mode: str = 'archive'):
+        self.mode = mode
 
     def open(self):
-        self._set_technical_timeout('0')
-        os.system(f"pm2 restart {self.PM2_WEBSITE_NAME}")
+        maintenance.disable()
 
     def close(self):
-        self._set_technical_timeout('1')
-        os.system(f"pm2 restart {self.PM2_WEBSITE_NAME}")
\ No newline at end of file
+        maintenance.enable(self.mode)
@@ -0,0 +1,117 @@
+"""
+Connection profiles for the shared SQLite file.
+The collector writes through a single writer connection while the website
+reads in parallel, so the DB runs in WAL mode: readers never block the
+writer and the writer never blocks readers.
+"""
+
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+BUSY_TIMEOUT_MS = 10_000
+# автоматический чекпоинт каждые ~4 МБ WAL (страницы по 4 КБ)
+WAL_AUTOCHECKPOINT_PAGES = 1000
+# после чекпоинта WAL обрезается до этого размера, а не остается раздутым
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+READER_MMAP_SIZE = 256 * 1024 * 1024
+# отрицательное значение - размер кэша в КБ
+READER_CACHE_SIZE = -32_000
+
+
+def connect_writer(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    # действует только на новую базу (до первой таблицы и до перехода в WAL);
+    # существующие переводит retention.py --enable-incremental-vacuum
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT_PAGES}")
+    conn.execute(f"PRAGMA journal_size_limit = {JOURNAL_SIZE_LIMIT}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def connect_reader(path: str, uri: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, uri=uri, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA mmap_size = {READER_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = {READER_CACHE_SIZE}")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def checkpoint(conn: sqlite3.Connection, mode: str = "TRUNCATE") -> tuple[int, int, int]:
+    # (busy, страниц в WAL, страниц перенесено в базу)
+    return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+
+class ReaderPool:
+    # общий на процесс пул читающих соединений, по списку на файл базы.
+    # архивы открываются с immutable=1: sqlite не ставит блокировки и не
+    # проверяет изменения файла, поэтому при смене mtime архива старые
+    # соединения к нему закрываются
+    def __init__(self, max_idle_per_path: int = 8):
+        self.max_idle_per_path = max_idle_per_path
+        self.lock = threading.Lock()
+        self.idle: dict[str, list[sqlite3.Connection]] = {}
+        self.versions: dict[str, int] = {}
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.in_use = 0
+
+    def _open(self, path: str, immutable: bool) -> sqlite3.Connection:
+        if immutable:
+            return connect_reader(f"file:{quote(path)}?mode=ro&immutable=1", uri=True)
+        return connect_reader(path)
+
+    def acquire(self, path: str, immutable: bool = False) -> sqlite3.Connection:
+        with self.lock:
+            if immutable:
+                version = os.stat(path).st_mtime_ns
+                if self.versions.get(path) != version:
+                    self._drop(path)
+                    self.versions[path] = version
+            idle = self.idle.get(path)
+            if idle:
+                self.reused += 1
+                self.in_use += 1
+                return idle.pop()
+            self.opened += 1
+            self.in_use += 1
+        return self._open(path, immutable)
+
+    def release(self, path: str, conn: sqlite3.Connection):
+        with self.lock:
+            self.in_use -= 1
+            idle = self.idle.setdefault(path, [])
+            if len(idle) < self.max_idle_per_path and not conn.in_transaction:
+                idle.append(conn)
+                return
+            self.closed += 1
+        conn.close()
+
+    def _drop(self, path: str):
+        for conn in self.idle.pop(path, []):
+            conn.close()
+            self.closed += 1
+
+    def close_all(self):
+        with self.lock:
+            for path in list(self.idle):
+                self._drop(path)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'paths': len(self.idle),
+                'idle': sum(len(conns) for conns in self.idle.values()),
+                'in_use': self.in_use,
+                'opened': self.opened,
+                'reused': self.reused,
+                'closed': self.closed,
+            }
@@ -0,0 +1,422 @@
+"""
+Schema migrations for the live DB and the monthly archives.
+The schema version is kept in PRAGMA user_version; every entry of
+MIGRATIONS moves it up by one. Run directly to migrate everything:
+    python db_migrations.py [--check] [--rebuild-totals] [--verify-totals] [--rebuild-search]
+The site holds archives open as immutable, so an archive is never changed
+in place: it is migrated in a copy that then replaces it (rewrite_archive).
+"""
+
+import os
+import re
+import sys
+import sqlite3
+from urllib.parse import quote
+import archive_snapshot
+import db_queries
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SCRIPT_DIR, 'sengoku_bot.db')
+ARCHIVE_DIR = os.path.join(SCRIPT_DIR, 'archives')
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set[str]:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def add_missing_columns(conn: sqlite3.Connection):
+    # старые базы создавались до появления этих колонок,
+    # а CREATE TABLE IF NOT EXISTS их уже не добавит
+    columns = {
+        'USERS': [
+            ('need_to_get', 'INTEGER DEFAULT 45'),
+            ('is_member', 'INTEGER DEFAULT 1'),
+            ('join_date', 'DATETIME'),
+            ('roles', 'TEXT'),
+        ],
+        'EVENTS': [
+            ('channel_id', 'INTEGER'),
+            ('channel_name', 'TEXT'),
+            ('guild_id', 'INTEGER'),
+            ('points', 'INTEGER DEFAULT 0'),
+            ('hidden', 'INTEGER DEFAULT 0'),
+            ('usefull_event', 'INTEGER DEFAULT 0'),
+        ],
+    }
+    for table, wanted in columns.items():
+        existing = _columns(conn, table)
+        for name, definition in wanted:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def add_indexes(conn: sqlite3.Connection):
+    # EVENTS_TO_USERS по message_id: джойн со стороны событий и проверка FK при удалении событий
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_to_users_message ON EVENTS_TO_USERS(message_id, ds_uid)")
+    # ветки события и проверка FK при удалении событий
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_branch_messages_parent ON BRANCH_MESSAGES(parent_message_id)")
+    # чистка старых событий по времени
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_read_time ON EVENTS(read_time)")
+    # INSERT OR REPLACE в USERS проверяет FK событий по автору
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_author ON EVENTS(author_user_id)")
+
+
+REBUILD_USER_TOTALS_SQL = """
+INSERT INTO USER_TOTALS (uid, event_count, total_points)
+SELECT u.uid,
+       COUNT(DISTINCT CASE WHEN e.disband != 1 THEN e.message_id END),
+       COALESCE(SUM(CASE WHEN e.disband != 1 THEN e.points ELSE 0 END), 0)
+  FROM USERS u
+  LEFT JOIN EVENTS_TO_USERS etu ON etu.ds_uid = u.uid
+  LEFT JOIN EVENTS e ON e.message_id = etu.message_id
+ GROUP BY u.uid
+"""
+
+# событие засчитывается, если disband != 1 (NULL не засчитывается - как в исходном агрегате)
+USER_TOTALS_SCHEMA = [
+    """
+CREATE TABLE IF NOT EXISTS USER_TOTALS (
+    uid INTEGER PRIMARY KEY,
+    event_count INTEGER NOT NULL DEFAULT 0,
+    total_points INTEGER NOT NULL DEFAULT 0
+)
+""",
+    "CREATE INDEX IF NOT EXISTS idx_user_totals_rank ON USER_TOTALS(total_points DESC, event_count DESC)",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_user_totals_user_insert AFTER INSERT ON USERS
+BEGIN
+    INSERT OR IGNORE INTO USER_TOTALS (uid) VALUES (NEW.uid);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_user_totals_link_insert AFTER INSERT ON EVENTS_TO_USERS
+BEGIN
+    INSERT INTO USER_TOTALS (uid, event_count, total_points)
+    SELECT NEW.ds_uid,
+           CASE WHEN e.disband != 1 THEN 1 ELSE 0 END,
+           CASE WHEN e.disband != 1 THEN COALESCE(e.points, 0) ELSE 0 END
+      FROM EVENTS e
+     WHERE e.message_id = NEW.message_id
+    ON CONFLICT(uid) DO UPDATE SET
+        event_count = event_count + excluded.event_count,
+        total_points = total_points + excluded.total_points;
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_user_totals_link_delete AFTER DELETE ON EVENTS_TO_USERS
+BEGIN
+    UPDATE USER_TOTALS
+       SET event_count = event_count - 1,
+           total_points = total_points - (SELECT COALESCE(points, 0) FROM EVENTS WHERE message_id = OLD.message_id)
+     WHERE uid = OLD.ds_uid
+       AND EXISTS (SELECT 1 FROM EVENTS WHERE message_id = OLD.message_id AND disband != 1);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_user_totals_event_update AFTER UPDATE OF disband, points ON EVENTS
+BEGIN
+    UPDATE USER_TOTALS
+       SET event_count = event_count
+               + (CASE WHEN NEW.disband != 1 THEN 1 ELSE 0 END)
+               - (CASE WHEN OLD.disband != 1 THEN 1 ELSE 0 END),
+           total_points = total_points
+               + (CASE WHEN NEW.disband != 1 THEN COALESCE(NEW.points, 0) ELSE 0 END)
+               - (CASE WHEN OLD.disband != 1 THEN COALESCE(OLD.points, 0) ELSE 0 END)
+     WHERE uid IN (SELECT ds_uid FROM EVENTS_TO_USERS WHERE message_id = NEW.message_id);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_user_totals_event_delete AFTER DELETE ON EVENTS
+WHEN OLD.disband != 1
+BEGIN
+    UPDATE USER_TOTALS
+       SET event_count = event_count - 1,
+           total_points = total_points - COALESCE(OLD.points, 0)
+     WHERE uid IN (SELECT ds_uid FROM EVENTS_TO_USERS WHERE message_id = OLD.message_id);
+END
+""",
+]
+
+
+def add_user_totals(conn: sqlite3.Connection):
+    for statement in USER_TOTALS_SCHEMA:
+        conn.execute(statement)
+    rebuild_user_totals(conn, commit=False)
+
+
+def add_branch_authors(conn: sqlite3.Connection):
+    # автор ветки нужен офлайн-пересчету: дизбанд в ветке считается только от автора события.
+    # у старых строк автор неизвестен (NULL)
+    if 'author_user_id' not in _columns(conn, 'BRANCH_MESSAGES'):
+        conn.execute("ALTER TABLE BRANCH_MESSAGES ADD COLUMN author_user_id INTEGER")
+
+
+# полнотекстовый поиск: строка на каждое сообщение (событие или ответ в ветке),
+# rowid - id сообщения, event_id - событие, к которому оно относится.
+# id стартового сообщения ветки может совпасть с id события - тогда строка события главнее
+SEARCH_SCHEMA = [
+    """
+CREATE VIRTUAL TABLE IF NOT EXISTS SEARCH_FTS USING fts5(
+    message_text,
+    event_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_search_event_insert AFTER INSERT ON EVENTS
+BEGIN
+    DELETE FROM SEARCH_FTS WHERE rowid = NEW.message_id;
+    INSERT INTO SEARCH_FTS (rowid, message_text, event_id) VALUES (NEW.message_id, NEW.message_text, NEW.message_id);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_search_event_update AFTER UPDATE OF message_text ON EVENTS
+BEGIN
+    DELETE FROM SEARCH_FTS WHERE rowid = OLD.message_id;
+    INSERT INTO SEARCH_FTS (rowid, message_text, event_id) VALUES (NEW.message_id, NEW.message_text, NEW.message_id);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_search_event_delete AFTER DELETE ON EVENTS
+BEGIN
+    DELETE FROM SEARCH_FTS WHERE rowid = OLD.message_id AND event_id = OLD.message_id;
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_search_branch_insert AFTER INSERT ON BRANCH_MESSAGES
+BEGIN
+    INSERT INTO SEARCH_FTS (rowid, message_text, event_id)
+    SELECT NEW.message_id, NEW.message_text, NEW.parent_message_id
+     WHERE NOT EXISTS (SELECT 1 FROM SEARCH_FTS WHERE rowid = NEW.message_id);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_search_branch_update AFTER UPDATE OF message_text, parent_message_id ON BRANCH_MESSAGES
+BEGIN
+    DELETE FROM SEARCH_FTS WHERE rowid = OLD.message_id AND event_id = OLD.parent_message_id;
+    INSERT INTO SEARCH_FTS (rowid, message_text, event_id)
+    SELECT NEW.message_id, NEW.message_text, NEW.parent_message_id
+     WHERE NOT EXISTS (SELECT 1 FROM SEARCH_FTS WHERE rowid = NEW.message_id);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS trg_search_branch_delete AFTER DELETE ON BRANCH_MESSAGES
+BEGIN
+    DELETE FROM SEARCH_FTS WHERE rowid = OLD.message_id AND event_id = OLD.parent_message_id;
+END
+""",
+]
+
+REBUILD_SEARCH_SQL = [
+    "DELETE FROM SEARCH_FTS",
+    "INSERT INTO SEARCH_FTS (rowid, message_text, event_id) SELECT message_id, message_text, message_id FROM EVENTS",
+    """
+INSERT INTO SEARCH_FTS (rowid, message_text, event_id)
+SELECT message_id, message_text, parent_message_id FROM BRANCH_MESSAGES
+ WHERE message_id NOT IN (SELECT message_id FROM EVENTS)
+""",
+]
+
+
+def add_search_index(conn: sqlite3.Connection):
+    for statement in SEARCH_SCHEMA:
+        conn.execute(statement)
+    rebuild_search_index(conn, commit=False)
+
+
+MIGRATIONS = [
+    add_missing_columns,
+    add_indexes,
+    add_user_totals,
+    add_branch_authors,
+    add_search_index,
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    version = schema_version(conn)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    return version
+
+
+def migrate_file(path: str) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+def rewrite_archive(path: str, change):
+    # архивы сайт держит открытыми с immutable=1 - файл на месте не трогаем:
+    # VACUUM INTO в копию, change(копия), проверка целостности и подмена целиком.
+    # открытые соединения дочитывают старый файл, новые видят уже подмененный
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+    try:
+        conn.execute("VACUUM INTO ?", (tmp_path,))
+    finally:
+        conn.close()
+    try:
+        copy = sqlite3.connect(tmp_path, isolation_level=None)
+        try:
+            result = change(copy)
+            check = copy.execute("PRAGMA integrity_check").fetchall()
+            if check != [('ok',)]:
+                raise RuntimeError(f"integrity check of {tmp_path} failed: {check}")
+            copy.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            copy.close()
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    # снапшот собирался со старого файла - пересобираем, если он был
+    if os.path.exists(archive_snapshot.snapshot_path(path)):
+        archive_snapshot.write_snapshot(path)
+    return result
+
+
+def rebuild_user_totals(conn: sqlite3.Connection, commit: bool = True):
+    conn.execute("DELETE FROM USER_TOTALS")
+    conn.execute(REBUILD_USER_TOTALS_SQL)
+    if commit:
+        conn.commit()
+
+
+def rebuild_search_index(conn: sqlite3.Connection, commit: bool = True):
+    for statement in REBUILD_SEARCH_SQL:
+        conn.execute(statement)
+    if commit:
+        conn.commit()
+
+
+def verify_user_totals(conn: sqlite3.Connection) -> list[tuple]:
+    # расхождения материализованных итогов с исходным агрегатом:
+    # (uid, (event_count, total_points) в USER_TOTALS, они же по агрегату)
+    materialized = {row[0]: (row[3], row[4]) for row in conn.execute(db_queries.LEADERBOARD_QUERY)}
+    aggregated = {row[0]: (row[3], row[4]) for row in conn.execute(db_queries.LEADERBOARD_AGGREGATE_QUERY)}
+    return [
+        (uid, materialized.get(uid), aggregated.get(uid))
+        for uid in sorted(materialized.keys() | aggregated.keys())
+        if materialized.get(uid) != aggregated.get(uid)
+    ]
+
+
+def archive_paths(archive_dir: str = ARCHIVE_DIR) -> list[str]:
+    if not os.path.exists(archive_dir):
+        return []
+    return sorted(
+        os.path.join(archive_dir, f) for f in os.listdir(archive_dir)
+        if re.match(r'^[a-z]+_\d{4}\.db$', f)
+    )
+
+
+# запросы сайта и чистки; в allowed - таблицы, которые по смыслу читаются целиком
+PLAN_CHECKS = [
+    ('leaderboard', db_queries.LEADERBOARD_QUERY, (), {'USER_TOTALS'}),
+    ('user', db_queries.USER_QUERY, (0,), set()),
+    ('user events', db_queries.USER_EVENTS_QUERY, (0,), set()),
+    ('user event count', db_queries.USER_EVENT_COUNT_QUERY, (0,), set()),
+    ('expired events', db_queries.EXPIRED_EVENTS_QUERY, ('', 1), set()),
+    ('expired counts', db_queries.EXPIRED_COUNTS_QUERY, {'cutoff': ''}, set()),
+    ('api leaderboard page', db_queries.LEADERBOARD_PAGE_QUERY, (0, 0, 0, 1), set()),
+    ('api user events page', db_queries.USER_EVENTS_PAGE_QUERY, (0, 0, 1, 0), set()),
+    ('search', db_queries.SEARCH_QUERY, ('"a"*', 1, 0), set()),
+    ('search count', db_queries.SEARCH_COUNT_QUERY, ('"a"*',), set()),
+    # отчет по смыслу читает все события месяца, но ссылки - по индексу
+    ('report events', db_queries.REPORT_EVENTS_QUERY, (), {'EVENTS'}),
+    ('report channels', db_queries.REPORT_CHANNELS_QUERY, (), {'EVENTS'}),
+    ('recompute events', db_queries.RECOMPUTE_EVENTS_QUERY, ('', ''), set()),
+    ('recompute branches', db_queries.RECOMPUTE_BRANCHES_QUERY, ('', ''), set()),
+    ('recompute links', db_queries.RECOMPUTE_LINKS_QUERY, ('', ''), set()),
+    ('event days', db_queries.EVENT_DAYS_QUERY, ('', ''), set()),
+]
+
+
+def full_scans(conn: sqlite3.Connection, query: str, params: tuple | dict = (), allowed: set[str] = frozenset()) -> list[str]:
+    scans = []
+    for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params):
+        detail = row[-1]
+        match = re.match(r'^SCAN (\w+)', detail)
+        if not match or detail == 'SCAN CONSTANT ROW':
+            continue
+        # fts5 с MATCH идет по своему индексу (M в idxStr); без M - полный перебор
+        virtual = re.search(r'VIRTUAL TABLE INDEX \d+:(\S*)', detail)
+        if virtual and 'M' in virtual.group(1):
+            continue
+        table = match.group(1)
+        alias_of = re.search(rf'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?{table}\b', query, re.IGNORECASE)
+        if table in allowed or (alias_of and alias_of.group(1) in allowed):
+            continue
+        scans.append(detail)
+    return scans
+
+
+def check_query_plans(conn: sqlite3.Connection) -> list[str]:
+    problems = []
+    for name, query, params, allowed in PLAN_CHECKS:
+        for detail in full_scans(conn, query, params, allowed):
+            problems.append(f"{name}: {detail}")
+    return problems
+
+
+def main():
+    rebuild_totals = '--rebuild-totals' in sys.argv
+    rebuild_search = '--rebuild-search' in sys.argv
+
+    def update(conn: sqlite3.Connection) -> int:
+        version = migrate(conn)
+        if rebuild_totals:
+            rebuild_user_totals(conn)
+            print("    USER_TOTALS rebuilt")
+        if rebuild_search:
+            rebuild_search_index(conn)
+            print("    SEARCH_FTS rebuilt")
+        return version
+
+    paths = ([DB_PATH] if os.path.exists(DB_PATH) else []) + archive_paths()
+    failed = False
+    for path in paths:
+        if path == DB_PATH:
+            conn = sqlite3.connect(path)
+            version = update(conn)
+        else:
+            conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+            version = schema_version(conn)
+            if version < len(MIGRATIONS) or rebuild_totals or rebuild_search:
+                conn.close()
+                version = rewrite_archive(path, update)
+                conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+        print(f"{path}: schema version {version}")
+        try:
+            if '--verify-totals' in sys.argv:
+                for uid, materialized, aggregated in verify_user_totals(conn):
+                    failed = True
+                    print(f"    USER_TOTALS mismatch for {uid}: {materialized} != {aggregated}")
+            if '--check' in sys.argv:
+                for problem in check_query_plans(conn):
+                    failed = True
+                    print(f"    full scan in {problem}")
+        finally:
+            conn.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# запросы, общие для коллектора (db_worker) и сайта (app)
+
+# таблица лидеров из материализованных итогов USER_TOTALS (их держат триггеры)
+LEADERBOARD_SELECT = """
+      SELECT u.uid,
+           COALESCE(NULLIF(u.server_username, ''), u.global_username) AS display_name,
+           u.liable,
+           t.event_count,
+           t.total_points,
+           u.need_to_get,
+           u.is_member
+      FROM USER_TOTALS t
+      JOIN USERS u ON u.uid = t.uid
+      WHERE COALESCE(NULLIF(u.server_username, ''), u.global_username) != 'D9dka'
+"""
+LEADERBOARD_QUERY = LEADERBOARD_SELECT + """
+      ORDER BY t.total_points DESC, t.event_count DESC, display_name COLLATE NOCASE ASC
+"""
+
+# исходный агрегат: для баз без USER_TOTALS и для сверки итогов
+LEADERBOARD_AGGREGATE_SELECT = """
+      SELECT u.uid,
+           COALESCE(NULLIF(u.server_username, ''), u.global_username) AS display_name,
+           u.liable,
+           COUNT(DISTINCT CASE WHEN e.disband != 1 THEN e.message_id END) AS event_count,
+           COALESCE(SUM(CASE WHEN e.disband != 1 THEN e.points ELSE 0 END), 0) AS total_points,
+           u.need_to_get,
+           u.is_member
+      FROM USERS u
+      LEFT JOIN EVENTS_TO_USERS etu ON etu.ds_uid = u.uid
+      LEFT JOIN EVENTS e ON e.message_id = etu.message_id
+      WHERE COALESCE(NULLIF(u.server_username, ''), u.global_username) != 'D9dka'
+      GROUP BY u.uid
+"""
+LEADERBOARD_AGGREGATE_QUERY = LEADERBOARD_AGGREGATE_SELECT + """
+      ORDER BY total_points DESC, event_count DESC, display_name COLLATE NOCASE ASC
+"""
+
+USER_QUERY = "SELECT uid, COALESCE(NULLIF(global_username, ''), server_username) AS display_name FROM USERS WHERE uid=?"
+
+# скрытые события маскируются прямо в запросе
+HIDDEN_EVENT_TEXT = "А тебя это ебать не должно"
+MASKED_EVENT_COLUMNS = f"""
+        CASE WHEN e.hidden THEN 0 ELSE e.message_id END AS message_id,
+        CASE WHEN e.hidden THEN 0 ELSE e.guild_id END AS guild_id,
+        CASE WHEN e.hidden THEN 0 ELSE e.channel_id END AS channel_id,
+        CASE WHEN e.hidden THEN 'None' ELSE e.channel_name END AS channel_name,
+        CASE WHEN e.hidden THEN '{HIDDEN_EVENT_TEXT}' ELSE e.message_text END AS message_text,
+        e.read_time, e.disband, e.points, e.hidden
+"""
+
+USER_EVENTS_QUERY = f"""
+        SELECT {MASKED_EVENT_COLUMNS}
+        FROM EVENTS_TO_USERS etu
+        JOIN EVENTS e ON e.message_id = etu.message_id
+        WHERE etu.ds_uid = ?
+        ORDER BY etu.message_id DESC
+"""
+
+# keyset-пагинация: страница начинается строго после курсора (message_id предыдущей страницы)
+USER_EVENTS_PAGE_QUERY = f"""
+        SELECT {MASKED_EVENT_COLUMNS}
+        FROM EVENTS_TO_USERS etu
+        JOIN EVENTS e ON e.message_id = etu.message_id
+        WHERE etu.ds_uid = ? AND etu.message_id < ?
+        ORDER BY etu.message_id DESC
+        LIMIT ? OFFSET ?
+"""
+
+USER_EVENT_COUNT_QUERY = "SELECT COUNT(*) FROM EVENTS_TO_USERS WHERE ds_uid = ?"
+
+EXPIRED_EVENTS_QUERY = "SELECT message_id FROM EVENTS WHERE read_time < ? ORDER BY read_time LIMIT ?"
+# сколько строк уйдет при чистке: (событий, ссылок на пользователей, сообщений в ветках)
+EXPIRED_COUNTS_QUERY = """
+        SELECT (SELECT COUNT(*) FROM EVENTS WHERE read_time < :cutoff),
+               (SELECT COUNT(*) FROM EVENTS_TO_USERS WHERE message_id IN (SELECT message_id FROM EVENTS WHERE read_time < :cutoff)),
+               (SELECT COUNT(*) FROM BRANCH_MESSAGES WHERE parent_message_id IN (SELECT message_id FROM EVENTS WHERE read_time < :cutoff))
+"""
+
+# поиск по SEARCH_FTS (см. db_migrations.SEARCH_SCHEMA). скрытые события в выдачу не попадают
+# совсем: совпадение по замаскированному тексту и так выдало бы, что в нем написано.
+# найденное место в тексте обрамляется \x02 ... \x03
+SEARCH_QUERY = f"""
+        SELECT {MASKED_EVENT_COLUMNS},
+               f.rowid != f.event_id AS in_thread,
+               snippet(SEARCH_FTS, 0, char(2), char(3), '…', 24) AS snippet
+        FROM SEARCH_FTS f
+        JOIN EVENTS e ON e.message_id = f.event_id
+        WHERE SEARCH_FTS MATCH ? AND NOT e.hidden
+        ORDER BY f.rank
+        LIMIT ? OFFSET ?
+"""
+SEARCH_COUNT_QUERY = """
+        SELECT COUNT(*)
+        FROM SEARCH_FTS f
+        JOIN EVENTS e ON e.message_id = f.event_id
+        WHERE SEARCH_FTS MATCH ? AND NOT e.hidden
+"""
+
+# все события всех пользователей подряд - для снапшота архива (archive_snapshot.py)
+SNAPSHOT_EVENTS_QUERY = f"""
+        SELECT etu.ds_uid, {MASKED_EVENT_COLUMNS}
+        FROM EVENTS_TO_USERS etu
+        JOIN EVENTS e ON e.message_id = etu.message_id
+        ORDER BY etu.ds_uid, etu.message_id DESC
+"""
+SNAPSHOT_USERS_QUERY = "SELECT uid, COALESCE(NULLIF(global_username, ''), server_username) AS display_name FROM USERS ORDER BY uid"
+
+# отчет за месяц: события со скрытыми полями как на сайте и сводка по каналам
+REPORT_EVENTS_QUERY = f"""
+        SELECT {MASKED_EVENT_COLUMNS}, COUNT(etu.ds_uid) AS users
+        FROM EVENTS e
+        LEFT JOIN EVENTS_TO_USERS etu ON etu.message_id = e.message_id
+        GROUP BY e.message_id
+        ORDER BY e.read_time
+"""
+REPORT_CHANNELS_QUERY = f"""
+        SELECT channel_name,
+               COUNT(*) AS events,
+               SUM(disband = 1) AS disbanded,
+               SUM(CASE WHEN disband != 1 THEN points ELSE 0 END) AS points,
+               SUM(CASE WHEN disband != 1 THEN users ELSE 0 END) AS attendances
+        FROM ({REPORT_EVENTS_QUERY})
+        GROUP BY channel_id
+        ORDER BY events DESC
+"""
+
+# офлайн-пересчет месяца: события окна [after, before) и все, что нужно правилам
+RECOMPUTE_EVENTS_QUERY = """
+        SELECT message_id, author_user_id, message_text, disband, channel_id, hidden, points
+        FROM EVENTS
+        WHERE read_time >= ? AND read_time < ?
+"""
+RECOMPUTE_BRANCHES_QUERY = """
+        SELECT bm.parent_message_id, bm.message_id, bm.message_text, bm.author_user_id
+        FROM EVENTS e
+        JOIN BRANCH_MESSAGES bm ON bm.parent_message_id = e.message_id
+        WHERE e.read_time >= ? AND e.read_time < ?
+        ORDER BY bm.message_id
+"""
+RECOMPUTE_LINKS_QUERY = """
+        SELECT etu.message_id, etu.ds_uid
+        FROM EVENTS e
+        JOIN EVENTS_TO_USERS etu ON etu.message_id = e.message_id
+        WHERE e.read_time >= ? AND e.read_time < ?
+"""
+UPDATE_EVENT_SCORE_SQL = "UPDATE EVENTS SET disband = ?, points = ? WHERE message_id = ?"
+
+# дни (по UTC), за которые в базе есть хоть одно событие
+EVENT_DAYS_QUERY = "SELECT DISTINCT substr(read_time, 1, 10) FROM EVENTS WHERE read_time >= ? AND read_time < ?"
+
+
+LEADERBOARD_PAGE_ORDER = """
+      WHERE (lb.total_points, lb.event_count, -lb.uid) < (?, ?, ?)
+      ORDER BY lb.total_points DESC, lb.event_count DESC, lb.uid ASC
+      LIMIT ?
+"""
+LEADERBOARD_PAGE_QUERY = f"SELECT * FROM ({LEADERBOARD_SELECT}) lb {LEADERBOARD_PAGE_ORDER}"
+LEADERBOARD_AGGREGATE_PAGE_QUERY = f"SELECT * FROM ({LEADERBOARD_AGGREGATE_SELECT}) lb {LEADERBOARD_PAGE_ORDER}"
+
+
+def has_table(conn, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
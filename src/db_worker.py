@@ -1,15 +1,130 @@
-import sqlite3
 import datetime
 import datatypes
+import db_queries
+import db_migrations
+import db_connections
 import os
 import pandas as pd
+from collections import OrderedDict
+
+# upsert: visible и timeout - ручные пометки из базы, из discord они не приходят
+# и при обновлении пользователя не перетираются
+INSERT_USER_SQL = '''
+INSERT INTO USERS (
+                     uid,
+                     server_username,
+                     global_username,
+                     liable,
+                     visible,
+                     timeout,
+                     need_to_get,
+                     is_member,
+                     join_date,
+                     roles
+                    )
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(uid) DO UPDATE SET
+    server_username = excluded.server_username,
+    global_username = excluded.global_username,
+    liable = excluded.liable,
+    need_to_get = excluded.need_to_get,
+    is_member = excluded.is_member,
+    join_date = excluded.join_date,
+    roles = excluded.roles
+'''
+
+# upsert, а не REPLACE: REPLACE удаляет строку без DELETE-триггеров и итоги в USER_TOTALS поехали бы
+INSERT_EVENT_SQL = '''
+INSERT INTO EVENTS (message_id, author_user_id, message_text, disband, read_time, channel_id, channel_name, guild_id, points, hidden, usefull_event)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(message_id) DO UPDATE SET
+    author_user_id = excluded.author_user_id,
+    message_text = excluded.message_text,
+    disband = excluded.disband,
+    read_time = excluded.read_time,
+    channel_id = excluded.channel_id,
+    channel_name = excluded.channel_name,
+    guild_id = excluded.guild_id,
+    points = excluded.points,
+    hidden = excluded.hidden,
+    usefull_event = excluded.usefull_event
+'''
+
+# тоже upsert: REPLACE удалил бы строку мимо триггеров поискового индекса
+INSERT_BRANCH_MESSAGE_SQL = '''
+INSERT INTO BRANCH_MESSAGES (message_id, parent_message_id, message_text, read_time, author_user_id)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(message_id) DO UPDATE SET
+    parent_message_id = excluded.parent_message_id,
+    message_text = excluded.message_text,
+    read_time = excluded.read_time,
+    author_user_id = excluded.author_user_id
+'''
+
+INSERT_EVENT_USER_SQL = '''
+INSERT OR IGNORE INTO EVENTS_TO_USERS (ds_uid, message_id)
+VALUES (?, ?)
+'''
+
+# чекпоинт только двигается вперед, пересканирование старого окна его не откатывает
+UPSERT_CHECKPOINT_SQL = '''
+INSERT INTO CHANNEL_CHECKPOINTS (channel_id, last_message_id, updated_at)
+VALUES (?, ?, ?)
+ON CONFLICT(channel_id) DO UPDATE SET
+    last_message_id = MAX(last_message_id, excluded.last_message_id),
+    updated_at = excluded.updated_at
+'''
+
+
+def user_row(user: datatypes.User) -> tuple:
+    return (
+        user.uuid,
+        user.server_username,
+        user.global_username,
+        user.liable,
+        user.visible,
+        user.timeout.isoformat() if user.timeout else None,
+        user.need_to_get,
+        user.is_member,
+        user.join_date.isoformat() if user.join_date else None,
+        user.roles
+    )
+
+def event_row(event: datatypes.Event) -> tuple:
+    return (
+        event.message_id,
+        event.author.uuid,
+        event.message_text,
+        event.disband,
+        event.read_time.isoformat() if event.read_time else None,
+        event.channel_id,
+        event.channel_name,
+        event.guild_id,
+        event.points,
+        1 if event.hidden else 0,
+        1 if event.usefull_event else 0
+    )
+
+def branch_message_row(branch_message: datatypes.BranchMessage, parent_message_id: int) -> tuple:
+    return (
+        branch_message.message_id,
+        parent_message_id,
+        branch_message.message_text,
+        branch_message.read_time.isoformat() if branch_message.read_time else None,
+        branch_message.author_id
+    )
+
+def checkpoint_row(channel_id: int, message_id: int) -> tuple:
+    return (channel_id, message_id, datetime.datetime.now(datetime.timezone.utc).isoformat())
+
+
 class DBWorker:
     def __init__(self, db_path: str = os.path.join(
             os.path.dirname(os.path.abspath(__file__)),
             'sengoku_bot.db'
-        )):
-        self.conn = sqlite3.connect(db_path)
-        self.conn.execute("PRAGMA foreign_keys = ON")
+        ), user_cache_size: int | None = None):
+        self.users = UserCache(user_cache_size)
+        self.conn = db_connections.connect_writer(db_path)
         self.cursor = self.conn.cursor()
         self.cursor.execute('''
 CREATE TABLE IF NOT EXISTS USERS (
@@ -56,9 +171,18 @@ CREATE TABLE IF NOT EXISTS BRANCH_MESSAGES (
     parent_message_id INTEGER,
     message_text TEXT,
     read_time DATETIME,
+    author_user_id INTEGER,
     FOREIGN KEY (parent_message_id) REFERENCES EVENTS(message_id)
 );
 ''')
+        self.cursor.execute('''
+CREATE TABLE IF NOT EXISTS CHANNEL_CHECKPOINTS (
+    channel_id INTEGER PRIMARY KEY,
+    last_message_id INTEGER NOT NULL,
+    updated_at DATETIME
+);
+''')
+        db_migrations.migrate(self.conn)
 
     def execute(self, query: str, params: tuple = ()):
         self.cursor.execute(query, params)
@@ -73,27 +197,24 @@ CREATE TABLE IF NOT EXISTS BRANCH_MESSAGES (
         self.cursor.execute(query, params)
         return self.cursor.fetchone()
 
+    def checkpoint(self) -> tuple[int, int, int]:
+        return db_connections.checkpoint(self.conn)
+
     def close(self):
+        # на закрытии переносим WAL в базу целиком, чтобы файл не рос между запусками
+        self.checkpoint()
         self.conn.close()
 
     def get_user_info(self) -> list[datatypes.User]:
-        data = self.cursor.execute("""
-      SELECT u.uid,
-           COALESCE(NULLIF(u.server_username, ''), u.global_username) AS display_name,
-           u.liable,
-           COUNT(DISTINCT CASE WHEN e.disband != 1 THEN e.message_id END) AS event_count,
-           COALESCE(SUM(CASE WHEN e.disband != 1 THEN e.points ELSE 0 END), 0) AS total_points,
-           u.need_to_get,
-           u.is_member
-      FROM USERS u
-      LEFT JOIN EVENTS_TO_USERS etu ON etu.ds_uid = u.uid
-      LEFT JOIN EVENTS e ON e.message_id = etu.message_id
-      WHERE COALESCE(NULLIF(u.server_username, ''), u.global_username) != 'D9dka'
-      GROUP BY u.uid
-      ORDER BY total_points DESC, event_count DESC, display_name COLLATE NOCASE ASC
-    """)
+        data = self.cursor.execute(db_queries.LEADERBOARD_QUERY)
         return data.fetchall()
     
+    def rebuild_user_totals(self):
+        db_migrations.rebuild_user_totals(self.conn)
+
+    def verify_user_totals(self) -> list[tuple]:
+        return db_migrations.verify_user_totals(self.conn)
+
     def load_database_as_dataframe(self) -> pd.DataFrame:
         data = self.get_user_info()
         columns = ['uid', 'display_name', 'liable', 'event_count', 'total_points', 'need_to_get', 'is_member']
@@ -101,72 +222,39 @@ CREATE TABLE IF NOT EXISTS BRANCH_MESSAGES (
         return df
 
     def add_user(self, user: datatypes.User):
-        self.execute('''
-INSERT OR REPLACE INTO USERS (
-                     uid,
-                     server_username,
-                     global_username,
-                     liable,
-                     visible,
-                     timeout,
-                     need_to_get,
-                     is_member,
-                     join_date,
-                     roles
-                    )
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-''', (
-        user.uuid,
-        user.server_username,
-        user.global_username,
-        user.liable,
-        user.visible,
-        user.timeout.isoformat() if user.timeout else None,
-        user.need_to_get,
-        user.is_member,
-        user.join_date.isoformat() if user.join_date else None,
-        user.roles
-    ))
-        
+        row = user_row(user)
+        if not self.users.is_dirty(row):
+            return
+        self.execute(INSERT_USER_SQL, row)
+        self.users.writes += 1
+        self.users.stored(row)
+
     def add_branch_message(self, branch_message: datatypes.BranchMessage, parent_message_id: int):
-        self.execute('''
-INSERT OR REPLACE INTO BRANCH_MESSAGES (message_id, parent_message_id, message_text, read_time)
-VALUES (?, ?, ?, ?)
-''', (branch_message.message_id, parent_message_id, branch_message.message_text, branch_message.read_time.isoformat() if branch_message.read_time else None))
-        
+        self.execute(INSERT_BRANCH_MESSAGE_SQL, branch_message_row(branch_message, parent_message_id))
+
     def add_event_user_link(self, user_id: int, message_id: int):
-        self.execute('''
-INSERT OR REPLACE INTO EVENTS_TO_USERS (ds_uid, message_id)
-VALUES (?, ?)
-''', (user_id, message_id))
+        self.execute(INSERT_EVENT_USER_SQL, (user_id, message_id))
 
     def add_event(self, event: datatypes.Event):
-        self.add_user(event.author)
-        self.execute('''
-INSERT OR REPLACE INTO EVENTS (message_id, author_user_id, message_text, disband, read_time, channel_id, channel_name, guild_id, points, hidden, usefull_event)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-''', (
-        event.message_id,
-        event.author.uuid,
-        event.message_text,
-        event.disband,
-        event.read_time.isoformat() if event.read_time else None,
-        event.channel_id,
-        event.channel_name,
-        event.guild_id,
-        event.points,
-        1 if event.hidden else 0,
-        1 if event.usefull_event else 0
-        ))
-        for mu in event.mentioned_users:
-            self.add_user(mu)
-        for bm in event.branch_messages:
-            self.add_branch_message(bm, event.message_id)
-        for mu in event.mentioned_users:
-            self.add_event_user_link(mu.uuid, event.message_id)
+        with self.batch() as batch:
+            batch.add(event, checkpoint=False)
+
+    def batch(self, size: int = 200) -> 'EventBatch':
+        return EventBatch(self, size)
+
+    def get_checkpoint(self, channel_id: int) -> int | None:
+        row = self.fetchone('SELECT last_message_id FROM CHANNEL_CHECKPOINTS WHERE channel_id=?', (channel_id,))
+        return row[0] if row else None
+
+    def set_checkpoint(self, channel_id: int, message_id: int):
+        self.execute(UPSERT_CHECKPOINT_SQL, checkpoint_row(channel_id, message_id))
 
     def get_user(self, uid: int) -> datatypes.User | None:
-        row = self.fetchone('SELECT * FROM USERS WHERE uid=?', (uid,))
+        if uid in self.users:
+            row = self.users.get(uid)
+        else:
+            row = self.fetchone('SELECT * FROM USERS WHERE uid=?', (uid,))
+            self.users.stored(row, uid)
         if row:
             return datatypes.User(
                 uuid=row[0],
@@ -174,6 +262,119 @@ VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 global_username=row[2],
                 liable=row[3],
                 visible=row[4],
-                timeout=row[5]
+                timeout=row[5],
+                need_to_get=row[6],
+                is_member=row[7],
+                join_date=datetime.datetime.fromisoformat(row[8]) if row[8] else None,
+                roles=row[9]
             )
-        return None
\ No newline at end of file
+        return None
+
+
+class UserCache:
+    # кэш строк USERS в том виде, в каком они лежат в базе (см. user_row).
+    # чтение из базы - один раз на пользователя, запись - только если строка
+    # отличается от сохраненной (грязная). max_size=None - без вытеснения
+    def __init__(self, max_size: int | None = None):
+        self.max_size = max_size
+        self.rows: OrderedDict[int, tuple | None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skipped_writes = 0
+
+    def __contains__(self, uid: int) -> bool:
+        if uid in self.rows:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, uid: int) -> tuple | None:
+        self.rows.move_to_end(uid)
+        return self.rows[uid]
+
+    def is_dirty(self, row: tuple) -> bool:
+        if row[0] in self.rows and self.rows[row[0]] == row:
+            self.skipped_writes += 1
+            return False
+        return True
+
+    def stored(self, row: tuple | None, uid: int = None):
+        # row=None запоминает, что пользователя в базе нет
+        uid = row[0] if row else uid
+        self.rows[uid] = tuple(row) if row else None
+        self.rows.move_to_end(uid)
+        if self.max_size is not None:
+            while len(self.rows) > self.max_size:
+                self.rows.popitem(last=False)
+
+
+class EventBatch:
+    # буфер событий: накопленное пишется одной транзакцией через executemany
+    # вместо коммита на каждую строку; сброс каждые size событий и на выходе из with
+    def __init__(self, worker: DBWorker, size: int = 200):
+        self.worker = worker
+        self.size = max(1, size)
+        self.events: list[datatypes.Event] = []
+        self.checkpoints: dict[int, int] = {}
+        self.flushed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # то, что уже обработано, сохраняем даже при ошибке -
+        # следующий запуск продолжит с последнего чекпоинта
+        self.flush()
+        return False
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event: datatypes.Event, checkpoint: bool = True):
+        self.events.append(event)
+        if checkpoint and event.channel_id:
+            self.advance(event.channel_id, event.message_id)
+        if len(self.events) >= self.size:
+            self.flush()
+
+    def advance(self, channel_id: int, message_id: int):
+        # чекпоинт без события - для сообщения, которое не удалось разобрать и оно пропущено
+        self.checkpoints[channel_id] = max(self.checkpoints.get(channel_id, 0), message_id)
+
+    def flush(self):
+        if not self.events and not self.checkpoints:
+            return
+        # последняя версия пользователя побеждает, как и при построчном INSERT OR REPLACE
+        users = {}
+        events = []
+        branch_messages = []
+        links = []
+        for event in self.events:
+            users[event.author.uuid] = user_row(event.author)
+            for mu in event.mentioned_users:
+                users[mu.uuid] = user_row(mu)
+            events.append(event_row(event))
+            branch_messages.extend(branch_message_row(bm, event.message_id) for bm in event.branch_messages)
+            links.extend((mu.uuid, event.message_id) for mu in event.mentioned_users)
+        users = [row for row in users.values() if self.worker.users.is_dirty(row)]
+        checkpoints = [checkpoint_row(ch, mid) for ch, mid in self.checkpoints.items()]
+
+        with self.worker.conn:
+            cursor = self.worker.conn.cursor()
+            cursor.executemany(INSERT_USER_SQL, users)
+            cursor.executemany(INSERT_EVENT_SQL, events)
+            cursor.executemany(INSERT_BRANCH_MESSAGE_SQL, branch_messages)
+            cursor.executemany(INSERT_EVENT_USER_SQL, links)
+            cursor.executemany(UPSERT_CHECKPOINT_SQL, checkpoints)
+        # в кэш только после коммита, иначе при откате строки считались бы записанными
+        self.worker.users.writes += len(users)
+        for row in users:
+            self.worker.users.stored(row)
+        self.flushed += len(self.events)
+        self.events = []
+        self.checkpoints = {}
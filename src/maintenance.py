@@ -0,0 +1,49 @@
+"""
+Runtime maintenance switch for the website.
+The switch is a sentinel file next to the DB: the site stats it on every
+request, so turning maintenance on or off needs no restart.
+Modes:
+    archive - serve the latest monthly archive instead of the live DB
+    timeout - serve the "technical works" page
+"""
+
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAINTENANCE_FILE = os.environ.get("MAINTENANCE_FILE", os.path.join(SCRIPT_DIR, 'maintenance.flag'))
+MODES = ('archive', 'timeout')
+
+_cached = (None, None)
+
+
+def enable(mode: str = 'archive'):
+    if mode not in MODES:
+        raise ValueError(f"unknown maintenance mode {mode!r}, expected one of {MODES}")
+    tmp_path = MAINTENANCE_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(mode)
+    os.replace(tmp_path, MAINTENANCE_FILE)
+
+
+def disable():
+    try:
+        os.remove(MAINTENANCE_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def current_mode() -> str | None:
+    # старый способ через .env и рестарт тоже понимаем
+    if os.getenv("TECHNICAL_TIMEOUT", "0") == "1":
+        return 'timeout'
+    global _cached
+    try:
+        st = os.stat(MAINTENANCE_FILE)
+    except FileNotFoundError:
+        return None
+    version = (st.st_mtime_ns, st.st_size)
+    if _cached[0] != version:
+        with open(MAINTENANCE_FILE) as f:
+            mode = f.read().strip()
+        _cached = (version, mode if mode in MODES else 'timeout')
+    return _cached[1]
@@ -6,20 +6,22 @@ Run via cron on the 1st of each month:
 """
 
 import os
-import shutil
 import sqlite3
 from datetime import datetime, timedelta
 import sys
 import dotenv
-import datatypes
 import CONSTANTS
 import logger
+import archive_snapshot
+import db_connections
+import db_migrations
+import db_queries
+import recompute
 dotenv.load_dotenv()
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(SCRIPT_DIR, 'sengoku_bot.db')
 ARCHIVE_DIR = os.path.join(SCRIPT_DIR, 'archives')
-PM2_WEBSITE_NAME = os.getenv("PM2_WEBSITE_NAME", "sengoku-website")
 lgr = logger.get_logger("collector")
 
 # Create archives directory if it doesn't exist
@@ -27,14 +29,84 @@ os.makedirs(ARCHIVE_DIR, exist_ok=True)
 
 
 def recalculate_monthly_db(now: datetime = None):
-    os.environ["SENGOKU_AFTER"] = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M:%S%z")
-    os.environ["SENGOKU_BEFORE"] = now.replace(hour=23, minute=59, second=59, microsecond=0).strftime("%Y-%m-%dT%H:%M:%S%z")
-    os.environ["REACT_TO_MESSAGES"] = "false"
-    os.environ["MONTHLY_CALC"] = "true"
+    first = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    windows = [(first, now.replace(hour=23, minute=59, second=59, microsecond=0))]
+    if os.path.exists(DB_PATH):
+        # disband/очки пересчитываются по сохраненным сообщениям, в discord идем
+        # только за днями, которых в базе нет совсем
+        conn = db_connections.connect_writer(DB_PATH)
+        try:
+            total, changed = recompute.recompute(conn, first.date().isoformat(), (now.date() + timedelta(days=1)).isoformat())
+            missing = recompute.missing_days(conn, first.date(), now.date())
+        finally:
+            conn.close()
+        lgr.info(f"Recomputed {total} events offline, {changed} changed, {len(missing)} days missing")
+        # каждый кусок пропущенных дней обходится отдельно: полные дни между ними
+        # уже в базе, и повторно ходить за ними в discord незачем
+        windows = [
+            (datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.max.time()).replace(microsecond=0))
+            for start, end in recompute.missing_spans(missing)
+        ]
+        lgr.info(f"Crawling {len(windows)} windows: " + ", ".join(f"{a:%Y-%m-%d}..{b:%Y-%m-%d}" for a, b in windows))
+    # CONSTANTS уже импортирован и прочитал окружение - флаги ставим прямо в модуль,
+    # collector читает их в on_ready
+    CONSTANTS.REPORT_ONLY = not windows
+    CONSTANTS.REACT_TO_MESSAGES = False
+    CONSTANTS.MONTHLY_CALC = True
     CONSTANTS.TODAY -= timedelta(days=1)
     import collector
+    collector.SCAN_WINDOWS = windows
     collector.client.run(collector.TOKEN)
 
+# порядок важен: сначала ссылки на события, потом сами события (FK)
+RESET_TABLES = ('EVENTS_TO_USERS', 'BRANCH_MESSAGES', 'EVENTS')
+
+
+def snapshot_db(db_path: str, archive_path: str):
+    # VACUUM INTO пишет согласованный снимок (вместе с WAL) в новый компактный файл,
+    # коллектор и сайт при этом продолжают работать с базой
+    tmp_path = archive_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = db_connections.connect_writer(db_path)
+    try:
+        conn.execute("VACUUM INTO ?", (tmp_path,))
+    finally:
+        conn.close()
+
+    archive = sqlite3.connect(tmp_path)
+    try:
+        result = archive.execute("PRAGMA integrity_check").fetchall()
+        if result != [('ok',)]:
+            raise RuntimeError(f"integrity check of {tmp_path} failed: {result}")
+        # архив дальше только читается - без WAL, одним файлом
+        archive.execute("PRAGMA journal_mode = DELETE")
+        db_migrations.migrate(archive)
+    finally:
+        archive.close()
+    # сайт видит архив только целиком
+    os.replace(tmp_path, archive_path)
+
+
+def reset_live_db(db_path: str):
+    # чистим события одной транзакцией; USERS, их итоги и чекпоинты каналов остаются
+    conn = db_connections.connect_writer(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in RESET_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            if db_queries.has_table(conn, 'USER_TOTALS'):
+                conn.execute("UPDATE USER_TOTALS SET event_count = 0, total_points = 0")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        db_connections.checkpoint(conn)
+    finally:
+        conn.close()
+
+
 def move_db_to_archive(now: datetime):
     if not os.path.exists(DB_PATH):
         lgr.info(f"Error: Database not found at {DB_PATH}")
@@ -50,15 +122,21 @@ def move_db_to_archive(now: datetime):
     if os.path.exists(archive_path):
         lgr.info(f"Error: Archive already exists: {archive_path}")
         lgr.info("    This usually means the script ran twice this month.")
+        sys.exit(1)
 
     try:
-        # 1. Copy current DB to archive
+        # 1. Snapshot current DB to archive
         lgr.info(f"Archiving {DB_PATH} → {archive_path}")
-        shutil.copy2(DB_PATH, archive_path)
+        snapshot_db(DB_PATH, archive_path)
+        # готовые страницы архива для сайта; без них сайт просто читает архив через sql
+        try:
+            archive_snapshot.write_snapshot(archive_path)
+        except Exception as e:
+            lgr.info(f"Error writing archive snapshot: {e}")
 
         # 2. Reset current DB: delete all events
         lgr.info("Resetting current database (clearing events)...")
-        os.remove(DB_PATH)
+        reset_live_db(DB_PATH)
 
     except Exception as e:
         lgr.info(f"Error during archiving/reset: {e}")
@@ -68,9 +146,6 @@ def move_db_to_archive(now: datetime):
 
 def main():
     now = datetime.now() - timedelta(days=1)
-    website = datatypes.Website()
-    website.close()
-
     recalculate_monthly_db(now)
     move_db_to_archive(now)
 
@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    # LRU готовых html-страниц. ключ включает версию данных, поэтому после
+    # ночного прогона коллектора старые страницы текущей базы просто перестают
+    # совпадать; invalidate_live() выкидывает их сразу, чтобы не занимали место
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, str] = OrderedDict()
+        self.live_version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple) -> str | None:
+        with self.lock:
+            html = self.entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key: tuple, html: str):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_live(self, version: str):
+        # ключ: (маршрут, db, версия); у текущей базы db пустой
+        with self.lock:
+            if version == self.live_version:
+                return
+            self.live_version = version
+            stale = [key for key in self.entries if not key[1] and key[2] != version]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,88 @@
+import asyncio
+import time
+import discord
+import CONSTANTS
+import logger
+
+lgr = logger.get_logger("reactions")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ReactionDispatcher:
+    # реакции ставятся в фоне: сканирование только кладет задачу в очередь.
+    # у discord лимит на реакции считается по каналу, поэтому на каждый канал
+    # своя очередь, свой воркер и свой бакет
+    def __init__(self, client: discord.Client, rate: float = CONSTANTS.REACTION_RATE, burst: int = CONSTANTS.REACTION_BURST):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.queues: dict[int, asyncio.Queue] = {}
+        self.buckets: dict[int, TokenBucket] = {}
+        self.workers: dict[int, asyncio.Task] = {}
+        self.added = 0
+        self.swapped = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def submit(self, message: discord.Message, disband: bool):
+        route = message.channel.id
+        if route not in self.queues:
+            self.queues[route] = asyncio.Queue()
+            self.buckets[route] = TokenBucket(self.rate, self.burst)
+            self.workers[route] = asyncio.create_task(self._work(route))
+        self.queues[route].put_nowait((message, disband))
+
+    async def _work(self, route: int):
+        queue = self.queues[route]
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            message, disband = item
+            try:
+                await self._react(route, message, disband)
+            except Exception as e:
+                self.failed += 1
+                lgr.error(f"Failed to add reaction to message {message.id}: {e}")
+
+    async def _react(self, route: int, message: discord.Message, disband: bool):
+        wanted = CONSTANTS.REACTION_NO if disband else CONSTANTS.REACTION_YES
+        stale = CONSTANTS.REACTION_YES if disband else CONSTANTS.REACTION_NO
+        mine = {str(r.emoji) for r in message.reactions if r.me}
+        if wanted in mine and stale not in mine:
+            self.skipped += 1
+            return
+        bucket = self.buckets[route]
+        # вердикт по дизбанду поменялся - убираем старую реакцию
+        if stale in mine:
+            await bucket.acquire()
+            await message.remove_reaction(stale, self.client.user)
+            self.swapped += 1
+        if wanted not in mine:
+            await bucket.acquire()
+            lgr.info(f"adding reaction to message {message.id}, disband={int(disband)}")
+            await message.add_reaction(wanted)
+            self.added += 1
+
+    async def close(self):
+        for queue in self.queues.values():
+            queue.put_nowait(None)
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        lgr.info(f"reactions: added {self.added}, swapped {self.swapped}, skipped {self.skipped}, failed {self.failed}")
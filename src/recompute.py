@@ -0,0 +1,127 @@
+"""
+Offline recompute of disband/points for a month of stored events.
+Re-applies the collector rules (common.apply_event_rules) to the rows
+already in EVENTS/BRANCH_MESSAGES/EVENTS_TO_USERS, without Discord.
+Run directly to recompute a month of the live DB (default: last month):
+    python recompute.py [YYYY-MM] [--db path]
+"""
+
+import os
+import sys
+import sqlite3
+from datetime import date, datetime, timedelta
+import CONSTANTS
+import common
+import datatypes
+import db_connections
+import db_queries
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SCRIPT_DIR, 'sengoku_bot.db')
+
+
+def month_window(day: date) -> tuple[date, date]:
+    first = day.replace(day=1)
+    next_month = (first + timedelta(days=32)).replace(day=1)
+    return first, next_month
+
+
+def load_events(conn: sqlite3.Connection, after: str, before: str) -> tuple[list[datatypes.Event], dict[int, tuple]]:
+    # события окна в виде datatypes.Event + то, что было в базе до пересчета
+    events = {}
+    stored = {}
+    for message_id, author_id, text, disband, channel_id, hidden, points in conn.execute(db_queries.RECOMPUTE_EVENTS_QUERY, (after, before)):
+        events[message_id] = datatypes.Event(
+            message_id=message_id,
+            message_text=text or "",
+            author=datatypes.User(uuid=author_id) if author_id is not None else None,
+            channel_id=channel_id,
+            hidden=bool(hidden),
+            points=points,
+        )
+        stored[message_id] = (disband, points)
+    for parent_id, message_id, text, author_id in conn.execute(db_queries.RECOMPUTE_BRANCHES_QUERY, (after, before)):
+        events[parent_id].branch_messages.append(datatypes.BranchMessage(
+            message_id=message_id,
+            message_text=text or "",
+            author_id=author_id,
+        ))
+    for message_id, uid in conn.execute(db_queries.RECOMPUTE_LINKS_QUERY, (after, before)):
+        events[message_id].mentioned_users.append(datatypes.User(uuid=uid))
+    return list(events.values()), stored
+
+
+def channel_points(event: datatypes.Event, stored_points: int) -> int:
+    if event.channel_id in CONSTANTS.HIDDEN:
+        return CONSTANTS.HIDDEN[event.channel_id]
+    return CONSTANTS.CHANNELS.get(event.channel_id, stored_points or 0)
+
+
+def recompute(conn: sqlite3.Connection, after: str, before: str) -> tuple[int, int]:
+    # (событий в окне, из них изменилось); USER_TOTALS поправят триггеры на UPDATE
+    events, stored = load_events(conn, after, before)
+    updates = []
+    for event in events:
+        old_disband, old_points = stored[event.message_id]
+        common.apply_event_rules(event, channel_points(event, old_points))
+        # у веток, записанных до колонки author_user_id, автор неизвестен -
+        # дизбанд из такой ветки не проверить, оставляем то, что решил сборщик
+        unknown = any(bm.author_id is None and common.check_disband(bm.message_text) for bm in event.branch_messages)
+        if unknown and old_disband == 1:
+            event.disband = 1
+        if (event.disband, event.points) != (old_disband, old_points):
+            updates.append((event.disband, event.points, event.message_id))
+    with conn:
+        conn.executemany(db_queries.UPDATE_EVENT_SCORE_SQL, updates)
+    return len(events), len(updates)
+
+
+def missing_days(conn: sqlite3.Connection, first: date, last: date) -> list[date]:
+    # дни без единого события - сборщик в них не отработал, их придется обойти в discord
+    seen = {row[0] for row in conn.execute(db_queries.EVENT_DAYS_QUERY, (first.isoformat(), (last + timedelta(days=1)).isoformat()))}
+    days = []
+    day = first
+    while day <= last:
+        if day.isoformat() not in seen:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def missing_spans(days: list[date]) -> list[tuple[date, date]]:
+    # подряд идущие пропущенные дни склеиваются в отрезки (первый, последний день)
+    spans = []
+    for day in days:
+        if spans and day - spans[-1][1] == timedelta(days=1):
+            spans[-1] = (spans[-1][0], day)
+        else:
+            spans.append((day, day))
+    return spans
+
+
+def main():
+    args = sys.argv[1:]
+    db_path = DB_PATH
+    if '--db' in args:
+        db_path = args[args.index('--db') + 1]
+        args.remove('--db')
+        args.remove(db_path)
+    if args:
+        day = datetime.strptime(args[0], "%Y-%m").date()
+    else:
+        day = date.today().replace(day=1) - timedelta(days=1)
+    first, next_month = month_window(day)
+
+    conn = db_connections.connect_writer(db_path)
+    try:
+        total, changed = recompute(conn, first.isoformat(), next_month.isoformat())
+        print(f"{db_path}: {total} events in {first:%Y-%m}, {changed} changed")
+        last = min(next_month - timedelta(days=1), date.today())
+        for day in missing_days(conn, first, last):
+            print(f"    no events on {day}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Monthly report export straight from the DB cursor.
+Rows are streamed in chunks into xlsx (xlsxwriter constant_memory),
+CSV or Parquet files on disk, so memory does not grow with the month.
+Files over the Discord attachment limit are zipped, and split into
+parts if the zip is still too big (join them back with `cat`).
+Run directly to export the live DB:
+    python report_export.py [--db path] [--format xlsx|csv|parquet] [--out dir]
+"""
+
+import os
+import sys
+import csv
+import zipfile
+import sqlite3
+from urllib.parse import quote
+import CONSTANTS
+import db_queries
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SCRIPT_DIR, 'sengoku_bot.db')
+FORMATS = ('xlsx', 'csv', 'parquet')
+CHUNK_ROWS = 1000
+# сколько файлов discord принимает в одном сообщении
+DISCORD_FILES_PER_MESSAGE = 10
+
+# лист -> колонки (имя, тип) в порядке выборки
+LEADERBOARD_COLUMNS = [
+    ('uid', int), ('display_name', str), ('liable', int), ('event_count', int),
+    ('total_points', int), ('need_to_get', int), ('is_member', int),
+]
+EVENT_COLUMNS = [
+    ('message_id', int), ('guild_id', int), ('channel_id', int), ('channel_name', str),
+    ('message_text', str), ('read_time', str), ('disband', int), ('points', int),
+    ('hidden', int), ('users', int),
+]
+CHANNEL_COLUMNS = [
+    ('channel_name', str), ('events', int), ('disbanded', int), ('points', int), ('attendances', int),
+]
+SHEETS = ('Data', 'Events', 'Channels')
+
+
+def sheet_query(conn: sqlite3.Connection, sheet: str) -> tuple[str, list]:
+    if sheet == 'Data':
+        if db_queries.has_table(conn, 'USER_TOTALS'):
+            return db_queries.LEADERBOARD_QUERY, LEADERBOARD_COLUMNS
+        return db_queries.LEADERBOARD_AGGREGATE_QUERY, LEADERBOARD_COLUMNS
+    if sheet == 'Events':
+        return db_queries.REPORT_EVENTS_QUERY, EVENT_COLUMNS
+    if sheet == 'Channels':
+        return db_queries.REPORT_CHANNELS_QUERY, CHANNEL_COLUMNS
+    raise ValueError(f"unknown sheet {sheet!r}, expected one of {SHEETS}")
+
+
+def iter_chunks(conn: sqlite3.Connection, query: str):
+    cursor = conn.execute(query)
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+
+
+def write_xlsx(conn: sqlite3.Connection, path: str, sheets: tuple[str, ...]):
+    import xlsxwriter
+    # constant_memory: строка сбрасывается на диск, как только начата следующая
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_urls': False})
+    try:
+        for sheet in sheets:
+            query, columns = sheet_query(conn, sheet)
+            worksheet = workbook.add_worksheet(sheet)
+            worksheet.write_row(0, 0, [name for name, _ in columns])
+            row_number = 1
+            for rows in iter_chunks(conn, query):
+                for row in rows:
+                    worksheet.write_row(row_number, 0, row)
+                    row_number += 1
+    finally:
+        workbook.close()
+
+
+def write_csv(conn: sqlite3.Connection, path: str, sheet: str):
+    query, columns = sheet_query(conn, sheet)
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        for rows in iter_chunks(conn, query):
+            writer.writerows(rows)
+
+
+def write_parquet(conn: sqlite3.Connection, path: str, sheet: str):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("parquet export needs pyarrow: pip install pyarrow")
+    query, columns = sheet_query(conn, sheet)
+    schema = pa.schema([(name, pa.int64() if kind is int else pa.string()) for name, kind in columns])
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in iter_chunks(conn, query):
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema,
+            ))
+
+
+def export_report(conn: sqlite3.Connection, directory: str, fmt: str = 'xlsx', name: str = 'database', sheets: tuple[str, ...] = SHEETS) -> list[str]:
+    # xlsx - один файл с листами, csv и parquet - файл на лист
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown report format {fmt!r}, expected one of {FORMATS}")
+    if fmt == 'xlsx':
+        path = os.path.join(directory, f"{name}.xlsx")
+        write_xlsx(conn, path, sheets)
+        return [path]
+    paths = []
+    for sheet in sheets:
+        path = os.path.join(directory, f"{name}_{sheet.lower()}.{fmt}")
+        if fmt == 'csv':
+            write_csv(conn, path, sheet)
+        else:
+            write_parquet(conn, path, sheet)
+        paths.append(path)
+    return paths
+
+
+def fit_for_upload(paths: list[str], limit: int = CONSTANTS.DISCORD_ATTACHMENT_LIMIT) -> list[str]:
+    # файлы в лимите отдаются как есть; остальные жмутся в zip,
+    # а не влезший и после сжатия zip режется на части .001, .002, ...
+    result = []
+    for path in paths:
+        if os.path.getsize(path) <= limit:
+            result.append(path)
+            continue
+        zip_path = path + '.zip'
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+            archive.write(path, os.path.basename(path))
+        if os.path.getsize(zip_path) <= limit:
+            result.append(zip_path)
+            continue
+        result.extend(split_file(zip_path, limit))
+        os.remove(zip_path)
+    return result
+
+
+def split_file(path: str, limit: int) -> list[str]:
+    parts = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(limit)
+            if not data:
+                break
+            part = f"{path}.{len(parts) + 1:03d}"
+            with open(part, 'wb') as out:
+                out.write(data)
+            parts.append(part)
+    return parts
+
+
+def upload_batches(paths: list[str]) -> list[list[str]]:
+    return [paths[i:i + DISCORD_FILES_PER_MESSAGE] for i in range(0, len(paths), DISCORD_FILES_PER_MESSAGE)]
+
+
+def main():
+    args = sys.argv[1:]
+
+    def option(name: str, default: str) -> str:
+        return args[args.index(name) + 1] if name in args else default
+
+    db_path = option('--db', DB_PATH)
+    fmt = option('--format', CONSTANTS.REPORT_FORMAT)
+    out = option('--out', '.')
+    conn = sqlite3.connect(f"file:{quote(db_path)}?mode=ro", uri=True)
+    try:
+        paths = fit_for_upload(export_report(conn, out, fmt))
+    finally:
+        conn.close()
+    for path in paths:
+        print(f"{path}: {os.path.getsize(path)} bytes")
+
+
+if __name__ == "__main__":
+    main()
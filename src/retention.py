@@ -0,0 +1,232 @@
+"""
+Retention job: deletes events older than the retention window together
+with their EVENTS_TO_USERS links and BRANCH_MESSAGES, in small chunks so
+the writer lock is only held for a moment at a time. USER_TOTALS and
+SEARCH_FTS follow through their triggers. Freed pages go back to the OS
+gradually with auto_vacuum=INCREMENTAL and PRAGMA incremental_vacuum.
+Run from cron, e.g. nightly:
+    python retention.py [--dry-run] [--days N] [--archives] [--db path]
+Archives are only compacted unless ARCHIVE_RETENTION_DAYS (or --days) is set.
+The site opens archives as immutable, so an archive is never changed in
+place: it is cleaned in a copy that then replaces it, like snapshot_db.
+An existing live DB switches to auto_vacuum=INCREMENTAL only through a full
+VACUUM, which holds the writer lock for the whole rebuild. That is a
+separate one-time step, run with the site in maintenance mode:
+    python retention.py --enable-incremental-vacuum [--db path]
+"""
+
+import os
+import sys
+import time
+import sqlite3
+from urllib.parse import quote
+from datetime import datetime, timedelta, timezone
+import db_connections
+import db_migrations
+import db_queries
+import logger
+import maintenance
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SCRIPT_DIR, 'sengoku_bot.db')
+# "чистить все ивенты в базе старше трех месяцев" из README
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+# 0 - из архивов ничего не удаляется, только отдается свободное место
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))
+CHUNK_EVENTS = int(os.getenv("RETENTION_CHUNK", "500"))
+VACUUM_PAGES_PER_CHUNK = 256
+# пауза между кусками, чтобы коллектор успевал взять блокировку
+CHUNK_PAUSE = 0.05
+
+lgr = logger.get_logger("retention")
+
+
+def cutoff(days: int, now: datetime = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return (now - timedelta(days=days)).isoformat()
+
+
+def table_bytes(conn: sqlite3.Connection) -> dict[str, int] | None:
+    # байт на таблицу вместе с ее индексами; None, если sqlite собран без dbstat
+    try:
+        rows = conn.execute("""
+            SELECT m.tbl_name, SUM(s.pgsize)
+              FROM dbstat s
+              JOIN sqlite_master m ON m.name = s.name
+             GROUP BY m.tbl_name
+        """).fetchall()
+    except sqlite3.Error:
+        return None
+    sizes = {}
+    for table, size in rows:
+        # теневые таблицы fts5 (SEARCH_FTS_data, ...) считаем за SEARCH_FTS
+        if table.startswith('SEARCH_FTS'):
+            table = 'SEARCH_FTS'
+        sizes[table] = sizes.get(table, 0) + size
+    return sizes
+
+
+def plan(conn: sqlite3.Connection, before: str) -> dict:
+    # dry-run: сколько строк и байт освободит чистка
+    events, links, branches = conn.execute(db_queries.EXPIRED_COUNTS_QUERY, {'cutoff': before}).fetchone()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    free_bytes = conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+    expired = {'EVENTS': events, 'EVENTS_TO_USERS': links, 'BRANCH_MESSAGES': branches}
+    if db_queries.has_table(conn, 'SEARCH_FTS'):
+        expired['SEARCH_FTS'] = events + branches
+    estimated = 0
+    sizes = table_bytes(conn)
+    if sizes is None:
+        # без dbstat - доля событий от размера файла
+        total_events = conn.execute("SELECT COUNT(*) FROM EVENTS").fetchone()[0]
+        total_bytes = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+        estimated = int(total_bytes * events / total_events) if total_events else 0
+    else:
+        for table, rows in expired.items():
+            total = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if total:
+                estimated += int(sizes.get(table, 0) * rows / total)
+    return {
+        'rows': expired,
+        'bytes': estimated,
+        'free_bytes': free_bytes,
+        'auto_vacuum': conn.execute("PRAGMA auto_vacuum").fetchone()[0],
+    }
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    # существующую базу режим auto_vacuum меняет только полный VACUUM - один раз
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def switch_live_db(path: str, mode: str = 'archive') -> bool:
+    # полный VACUUM держит блокировку записи все время перестройки - на это время
+    # сайт уходит в режим техработ (если его туда еще не перевели)
+    conn = db_connections.connect_writer(path)
+    enabled_here = maintenance.current_mode() is None
+    if enabled_here:
+        maintenance.enable(mode)
+    try:
+        return enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+        if enabled_here:
+            maintenance.disable()
+
+
+def purge(conn: sqlite3.Connection, before: str, chunk: int = CHUNK_EVENTS, pause: float = CHUNK_PAUSE) -> int:
+    # удаляет истекшие события кусками по chunk штук; каждый кусок - своя короткая транзакция.
+    # сначала ссылки (триггер уменьшает USER_TOTALS, пока событие еще есть), потом ветки и события
+    deleted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = conn.execute(db_queries.EXPIRED_EVENTS_QUERY, (before, chunk)).fetchall()
+            conn.executemany("DELETE FROM EVENTS_TO_USERS WHERE message_id = ?", ids)
+            conn.executemany("DELETE FROM BRANCH_MESSAGES WHERE parent_message_id = ?", ids)
+            conn.executemany("DELETE FROM EVENTS WHERE message_id = ?", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        deleted += len(ids)
+        if ids:
+            # через execute() модуль sqlite3 делает один шаг и освобождает одну страницу,
+            # executescript доводит прагму до конца
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_CHUNK});")
+        if len(ids) < chunk:
+            break
+        time.sleep(pause)
+    # остаток свободных страниц
+    conn.executescript("PRAGMA incremental_vacuum;")
+    return deleted
+
+
+def rewrite_archive(path: str, before: str) -> int:
+    # чистка и сжатие идут в копии архива (см. db_migrations.rewrite_archive)
+    def clean(copy: sqlite3.Connection) -> int:
+        if not before:
+            # VACUUM INTO уже записал копию без свободных страниц
+            return 0
+        # итоги и поиск держатся триггерами - у старой базы их может еще не быть
+        db_migrations.migrate(copy)
+        # копию никто не читает: без пауз между кусками и с полным VACUUM в конце
+        deleted = purge(copy, before, pause=0)
+        copy.execute("VACUUM")
+        return deleted
+
+    return db_migrations.rewrite_archive(path, clean)
+
+
+def run(path: str, days: int, archive: bool = False, dry_run: bool = False) -> dict:
+    before = cutoff(days) if days > 0 else ''
+    if archive:
+        conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+    else:
+        conn = db_connections.connect_writer(path)
+        conn.isolation_level = None
+    try:
+        report = plan(conn, before)
+        report['path'] = path
+        report['cutoff'] = before or None
+        report['deleted'] = report['freed'] = 0
+        if dry_run:
+            return report
+        size_before = os.path.getsize(path)
+        if not archive:
+            if report['auto_vacuum'] != 2:
+                lgr.info(f"{path}: auto_vacuum is off, freed pages are only reused; "
+                         f"run retention.py --enable-incremental-vacuum once to give them back")
+            if before:
+                db_migrations.migrate(conn)
+                report['deleted'] = purge(conn, before)
+            db_connections.checkpoint(conn)
+    finally:
+        conn.close()
+    if archive:
+        # нечего удалять и сжимать - архив не трогаем, его снапшот и ETag страниц остаются в силе
+        if report['rows']['EVENTS'] == 0 and report['free_bytes'] == 0:
+            return report
+        report['deleted'] = rewrite_archive(path, before)
+    report['freed'] = size_before - os.path.getsize(path)
+    return report
+
+
+def main():
+    args = sys.argv[1:]
+    if '--enable-incremental-vacuum' in args:
+        path = args[args.index('--db') + 1] if '--db' in args else DB_PATH
+        if switch_live_db(path):
+            lgr.info(f"{path}: switched to auto_vacuum=INCREMENTAL")
+        else:
+            lgr.info(f"{path}: auto_vacuum=INCREMENTAL already")
+        return
+    dry_run = '--dry-run' in args
+    days = int(args[args.index('--days') + 1]) if '--days' in args else None
+    targets = []
+    if '--db' in args:
+        targets.append((args[args.index('--db') + 1], False))
+    elif os.path.exists(DB_PATH):
+        targets.append((DB_PATH, False))
+    if '--archives' in args:
+        targets += [(path, True) for path in db_migrations.archive_paths()]
+
+    for path, archive in targets:
+        window = days if days is not None else (ARCHIVE_RETENTION_DAYS if archive else RETENTION_DAYS)
+        report = run(path, window, archive=archive, dry_run=dry_run)
+        rows = ", ".join(f"{table} {count}" for table, count in report['rows'].items())
+        if dry_run:
+            print(f"{path}: older than {report['cutoff'] or '-'} would delete {rows}; "
+                  f"~{report['bytes'] / 1024 / 1024:.1f} MB of rows, {report['free_bytes'] / 1024 / 1024:.1f} MB already free; "
+                  f"auto_vacuum={report['auto_vacuum']}")
+        else:
+            lgr.info(f"{path}: deleted {report['deleted']} events older than {report['cutoff'] or '-'}, "
+                     f"file shrank by {report['freed'] / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Columnar scoring engine: loads events, links and users of a live or
+archived DB into pandas frames once and computes every user's totals
+with vectorized operations, under the current rules or a what-if set.
+Run directly to compare a what-if against the current rules:
+    python scoring.py [--db path ...] [--archives] [--points zvz=4] [--points <channel_id>=4]
+                      [--group-map-points N] [--treasury-points N] [--min-users N] [--need-to-get N]
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+from urllib.parse import quote
+import numpy as np
+import pandas as pd
+import CONSTANTS
+import common
+import db_migrations
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SCRIPT_DIR, 'sengoku_bot.db')
+
+EVENTS_SQL = "SELECT message_id, author_user_id, message_text, disband, channel_id, channel_name, hidden, points FROM EVENTS"
+BRANCHES_SQL = "SELECT parent_message_id AS message_id, message_text, author_user_id FROM BRANCH_MESSAGES"
+# архивы открываются только на чтение и не мигрируются - до v4 автора ветки в них нет
+BRANCHES_NO_AUTHOR_SQL = "SELECT parent_message_id AS message_id, message_text, NULL AS author_user_id FROM BRANCH_MESSAGES"
+LINKS_SQL = "SELECT ds_uid AS uid, message_id FROM EVENTS_TO_USERS"
+USERS_SQL = """
+      SELECT uid,
+           COALESCE(NULLIF(server_username, ''), global_username) AS display_name,
+           liable,
+           need_to_get,
+           is_member
+      FROM USERS
+      WHERE COALESCE(NULLIF(server_username, ''), global_username) != 'D9dka'
+"""
+
+TOTALS_COLUMNS = ['uid', 'display_name', 'liable', 'event_count', 'total_points', 'need_to_get', 'is_member']
+
+
+class Rules:
+    # правила начисления; по умолчанию - текущие из CONSTANTS.
+    # channel_points можно задавать по id канала или по его имени (channel_name)
+    def __init__(self,
+                 channel_points: dict = None,
+                 hidden_points: dict = None,
+                 group_map_names: list[str] = None,
+                 group_map_points: int = None,
+                 treasury_points: int = None,
+                 min_users: int = None,
+                 need_to_get: int | None = None):
+        self.channel_points = dict(CONSTANTS.CHANNELS if channel_points is None else channel_points)
+        self.hidden_points = dict(CONSTANTS.HIDDEN if hidden_points is None else hidden_points)
+        self.group_map_names = list(CONSTANTS.GROUP_MAP_NAMES if group_map_names is None else group_map_names)
+        self.group_map_points = CONSTANTS.POINTS_GROUP_MAP if group_map_points is None else group_map_points
+        self.treasury_points = CONSTANTS.TREASURY_POINTS if treasury_points is None else treasury_points
+        self.min_users = CONSTANTS.MIN_USERS if min_users is None else min_users
+        # None - норма каждого пользователя из USERS.need_to_get
+        self.need_to_get = need_to_get
+
+    def with_overrides(self, channel_points: dict = None, **overrides) -> 'Rules':
+        rules = Rules(
+            channel_points={**self.channel_points, **(channel_points or {})},
+            hidden_points=self.hidden_points,
+            group_map_names=self.group_map_names,
+            group_map_points=self.group_map_points,
+            treasury_points=self.treasury_points,
+            min_users=self.min_users,
+            need_to_get=self.need_to_get,
+        )
+        for name, value in overrides.items():
+            if not hasattr(rules, name):
+                raise ValueError(f"unknown rule {name!r}")
+            setattr(rules, name, value)
+        return rules
+
+
+class Frames:
+    # одна база в колонках. текстовые признаки (дизбанд, казна) считаются один раз
+    # при загрузке теми же функциями, что и в сборщике - от правил они не зависят
+    def __init__(self, events: pd.DataFrame, links: pd.DataFrame, users: pd.DataFrame, name: str = None):
+        self.events = events
+        self.links = links
+        self.users = users
+        self.name = name
+
+    @classmethod
+    def load(cls, path: str) -> 'Frames':
+        conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+        try:
+            events = pd.read_sql_query(EVENTS_SQL, conn)
+            branch_columns = {row[1] for row in conn.execute("PRAGMA table_info(BRANCH_MESSAGES)")}
+            branches = pd.read_sql_query(BRANCHES_SQL if 'author_user_id' in branch_columns else BRANCHES_NO_AUTHOR_SQL, conn)
+            links = pd.read_sql_query(LINKS_SQL, conn)
+            users = pd.read_sql_query(USERS_SQL, conn)
+        finally:
+            conn.close()
+
+        events['message_text'] = events['message_text'].fillna('')
+        events['text_lower'] = events['message_text'].str.lower()
+        texts = events['message_text'].drop_duplicates()
+        disband_texts = set(texts[texts.map(common.check_disband).astype(bool)])
+        treasury_texts = set(texts[texts.map(common.check_treasury).astype(bool)])
+
+        # дизбанд в ветке засчитывается только от автора события; у старых веток
+        # автор неизвестен - там остается то, что записал сборщик
+        branches['message_text'] = branches['message_text'].fillna('')
+        branches = branches.merge(events[['message_id', 'author_user_id', 'disband']], on='message_id', suffixes=('', '_event'))
+        branch_disband = branches['message_text'].map(common.check_disband).astype(bool)
+        by_author = branch_disband & (branches['author_user_id'] == branches['author_user_id_event'])
+        unknown = branch_disband & branches['author_user_id'].isna() & (branches['disband'] == 1)
+        branch_treasury = branches['message_text'].map(common.check_treasury).astype(bool)
+        disband_ids = set(branches.loc[by_author | unknown, 'message_id'])
+        treasury_ids = set(branches.loc[branch_treasury, 'message_id'])
+
+        events['text_disband'] = events['message_text'].isin(disband_texts) | events['message_id'].isin(disband_ids)
+        events['treasury'] = events['message_text'].isin(treasury_texts) | events['message_id'].isin(treasury_ids)
+        counts = links.groupby('message_id').size()
+        events['users'] = events['message_id'].map(counts).fillna(0).astype(np.int64)
+        events = events.drop(columns=['message_text', 'author_user_id'])
+        return cls(events, links, users, name=os.path.basename(path))
+
+
+def event_scores(frames: Frames, rules: Rules) -> pd.DataFrame:
+    # (message_id, points, counted) на каждое событие - векторный аналог common.apply_event_rules
+    events = frames.events
+    by_id = {k: v for k, v in rules.channel_points.items() if not isinstance(k, str)}
+    by_name = {k: v for k, v in rules.channel_points.items() if isinstance(k, str)}
+
+    # в скрытых каналах базой служат очки скрытого канала, в неизвестных - записанные
+    fallback = events['channel_id'].map(rules.hidden_points).fillna(events['points']).fillna(0)
+    points = events['channel_id'].map(by_id).fillna(fallback)
+    if by_name:
+        named = events['channel_name'].map(by_name)
+        points = named.fillna(points)
+    if rules.group_map_names:
+        pattern = "|".join(re.escape(name) for name in rules.group_map_names)
+        points = points.mask(events['text_lower'].str.contains(pattern, regex=True), rules.group_map_points)
+    in_hidden = events['channel_id'].isin(list(rules.hidden_points))
+    points = points.mask(in_hidden & events['treasury'], rules.treasury_points)
+
+    disband = events['text_disband'] | (events['users'] < rules.min_users)
+    return pd.DataFrame({
+        'message_id': events['message_id'],
+        'points': points.astype(np.int64),
+        'counted': ~disband,
+    })
+
+
+def score(frames: Frames | list[Frames], rules: Rules = None) -> pd.DataFrame:
+    # итоги по пользователям; при нескольких базах (архивах) суммируются
+    rules = rules or Rules()
+    parts = frames if isinstance(frames, list) else [frames]
+    totals = []
+    for part in parts:
+        scored = event_scores(part, rules)
+        links = part.links.merge(scored, on='message_id')
+        links['earned'] = np.where(links['counted'], links['points'], 0)
+        totals.append(links.groupby('uid').agg(event_count=('counted', 'sum'), total_points=('earned', 'sum')))
+    # пользователи берутся из последней базы - там самые свежие ники и нормы
+    users = parts[-1].users.set_index('uid')
+    summed = pd.concat(totals).groupby(level=0).sum() if totals else pd.DataFrame(columns=['event_count', 'total_points'])
+    result = users.join(summed, how='left').fillna({'event_count': 0, 'total_points': 0}).reset_index()
+    result[['event_count', 'total_points']] = result[['event_count', 'total_points']].astype(np.int64)
+    if rules.need_to_get is not None:
+        result['need_to_get'] = rules.need_to_get
+    result['quota_met'] = result['total_points'] >= result['need_to_get']
+    result = result.sort_values(
+        ['total_points', 'event_count', 'display_name'],
+        ascending=[False, False, True],
+        key=lambda column: column.str.lower() if column.name == 'display_name' else column,
+    )
+    return result[TOTALS_COLUMNS + ['quota_met']].reset_index(drop=True)
+
+
+def compare(frames: Frames | list[Frames], what_if: Rules, rules: Rules = None) -> pd.DataFrame:
+    base = score(frames, rules)
+    changed = score(frames, what_if)
+    result = base.merge(changed[['uid', 'event_count', 'total_points', 'need_to_get', 'quota_met']], on='uid', suffixes=('', '_what_if'))
+    result['points_delta'] = result['total_points_what_if'] - result['total_points']
+    return result.sort_values(['points_delta', 'total_points_what_if'], ascending=[False, False]).reset_index(drop=True)
+
+
+def parse_overrides(args: list[str]) -> dict:
+    overrides = {}
+    channel_points = {}
+    options = {
+        '--group-map-points': 'group_map_points',
+        '--treasury-points': 'treasury_points',
+        '--min-users': 'min_users',
+        '--need-to-get': 'need_to_get',
+    }
+    for i, arg in enumerate(args):
+        if arg == '--points':
+            key, value = args[i + 1].split('=')
+            channel_points[int(key) if key.isdigit() else key] = int(value)
+        elif arg in options:
+            overrides[options[arg]] = int(args[i + 1])
+    overrides['channel_points'] = channel_points
+    return overrides
+
+
+def main():
+    args = sys.argv[1:]
+    paths = [args[i + 1] for i, arg in enumerate(args) if arg == '--db']
+    if '--archives' in args:
+        paths = db_migrations.archive_paths() + paths
+    paths = paths or [DB_PATH]
+
+    started = time.perf_counter()
+    frames = [Frames.load(path) for path in paths]
+    loaded = time.perf_counter() - started
+
+    what_if = Rules().with_overrides(**parse_overrides(args))
+    started = time.perf_counter()
+    result = compare(frames, what_if)
+    elapsed = time.perf_counter() - started
+
+    events = sum(len(f.events) for f in frames)
+    print(f"{len(paths)} DB(s), {events} events: loaded in {loaded:.2f}s, scored twice in {elapsed * 1000:.0f}ms")
+    changed = result[result['points_delta'] != 0]
+    quota = (result['quota_met'].sum(), result['quota_met_what_if'].sum())
+    print(f"{len(changed)} users change points, quota met by {quota[0]} -> {quota[1]} users")
+    with pd.option_context('display.max_rows', 50, 'display.width', 200):
+        print(changed[['uid', 'display_name', 'total_points', 'total_points_what_if', 'points_delta', 'quota_met', 'quota_met_what_if']].head(50).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()